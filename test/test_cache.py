@@ -0,0 +1,100 @@
+# Copyright (c) 2011 Jyrki Pulliainen <jyrki@dywypi.org>
+# Copyright (c) 2010 Inoi Oy
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from nose.tools import eq_ as eq
+from .couch_util import setup, teardown, with_couchdb
+from .test_sharding import _create_shards
+from .util import with_ioloop
+
+import trombi
+from trombi.cache import ViewCache
+
+
+def test_view_cache_lru():
+    cache = ViewCache(max_bytes=10)
+    cache.put('a', b'aaaa')
+    cache.put('b', b'bbbb')
+    cache.get('a')
+    cache.put('c', b'cccc')
+    eq(cache.size, 8)
+    assert cache.get('b') is None
+    eq(cache.get('a').body, b'aaaa')
+
+    # Bodies larger than the whole cache are not stored
+    cache.put('d', b'd' * 11)
+    eq(len(cache), 2)
+
+
+def test_view_cache_expiry():
+    cache = ViewCache(ttl=0, stale_ttl=60)
+    entry = cache.put('a', b'aaaa', '"1"')
+    assert not entry.fresh()
+    assert entry.stale()
+    cache.ttl = 60
+    cache.refresh(entry)
+    assert entry.fresh()
+
+
+@with_ioloop
+@with_couchdb
+def test_cached_view(baseurl, ioloop):
+    db, = _create_shards(ioloop, baseurl, 1)
+    metrics = []
+    cache = ViewCache(ttl=60)
+    s = trombi.Server(baseurl, io_loop=ioloop, view_cache=cache,
+                      metrics=lambda name, value: metrics.append(name))
+    db = trombi.Database(s, db.name)
+    results = []
+
+    def got_view(result):
+        assert not result.error
+        results.append([row['key'] for row in result])
+        ioloop.stop()
+
+    def docs_created(result):
+        assert not result.error
+        ioloop.stop()
+
+    db.bulk_docs([{'key': i, 'value': i} for i in range(3)], docs_created)
+    ioloop.start()
+
+    for i in range(2):
+        handle = db.view('test', 'by_key', got_view, limit=2)
+        ioloop.start()
+        # Answers from the cache return a handle too
+        assert isinstance(handle, trombi.RequestHandle)
+    eq(metrics, ['view_cache.miss', 'view_cache.hit'])
+
+    # Expired entries are revalidated with their ETag
+    key, = cache._entries
+    cache.ttl = 0
+    cache.refresh(cache.get(key))
+    db.view('test', 'by_key', got_view, limit=2)
+    ioloop.start()
+    eq(metrics[-1], 'view_cache.revalidated')
+
+    db.view('test', 'by_key', got_view, limit=2, cache=False)
+    ioloop.start()
+    eq(len(metrics), 3)
+    eq(results, [[0, 1]] * 4)
@@ -25,6 +25,7 @@ from __future__ import with_statement
 
 from datetime import datetime
 import sys
+import time
 
 from nose.tools import eq_ as eq
 from .couch_util import setup, teardown, with_couchdb
@@ -60,6 +61,321 @@ def test_from_uri():
     eq(db.name, 'foobar')
 
 
+class _RecordingClient(object):
+    def __init__(self):
+        self.requests = []
+        self.callbacks = []
+
+    def fetch(self, url, callback, **kwargs):
+        self.requests.append((url, kwargs))
+        self.callbacks.append(callback)
+
+
+def test_request_headers():
+    s = trombi.Server('http://1.2.3.4', fetch_args={'request_timeout': 5})
+    s._client = client = _RecordingClient()
+    db = trombi.Database(s, 'foobar')
+    db.get('a/b', None)
+    db.get('a/b', None, attachments=True)
+
+    (url1, args1), (url2, args2) = client.requests
+    eq(url1, 'http://1.2.3.4/foobar/a%2Fb')
+    eq(url2, 'http://1.2.3.4/foobar/a%2Fb?attachments=true')
+    eq(args1['request_timeout'], 5)
+    eq(dict(args1['headers']), {'Content-Type': 'application/json'})
+    eq(dict(args2['headers']), {'Content-Type': 'application/json',
+                                'Accept': 'application/json'})
+    # Tornado modifies the headers, so they must not be shared
+    args1['headers']['Content-Length'] = '0'
+    db.get('a/b', None)
+    assert 'Content-Length' not in client.requests[-1][1]['headers']
+
+
+def test_request_priorities():
+    s = trombi.Server('http://1.2.3.4', max_concurrent=2,
+                      priority_weights={'interactive': 2, 'default': 1},
+                      background_limit=1)
+    s._client = client = _RecordingClient()
+    db = trombi.Database(s, 'foobar')
+    done = []
+
+    priorities = ['background'] * 3 + ['default'] * 2 + ['interactive'] * 3
+    for priority in priorities:
+        db.with_options(priority=priority).get(
+            priority, lambda doc: done.append(doc))
+    # The first background request found the capacity free
+    eq([url.rsplit('/', 1)[1] for url, kwargs in client.requests],
+       ['background', 'default'])
+
+    # Answer the requests one by one, in the order they were sent
+    order = []
+    while len(order) < len(client.requests):
+        url, kwargs = client.requests[len(order)]
+        order.append(url.rsplit('/', 1)[1][0])
+        client.callbacks[len(order) - 1](trombi.client._Response(404, b''))
+    eq(done, [None] * 8)
+    eq(''.join(order), 'bdiidibb')
+    eq(s._scheduler.active, 0)
+
+
+def test_changes_feeds_not_scheduled():
+    s = trombi.Server('http://1.2.3.4', max_concurrent=1)
+    s._client = client = _RecordingClient()
+    db = trombi.Database(s, 'foobar').with_options(priority='background')
+    db.get('doc', lambda doc: None)
+    # The only place is taken, but changes feeds don't need one
+    db.changes(lambda result: None, feed='longpoll')
+    db.changes(lambda result: None, feed='continuous')
+    db.changes(lambda result: None)
+    urls = [url for url, kwargs in client.requests]
+    eq([url.rsplit('/', 1)[1].split('&')[0] for url in urls],
+       ['doc', '_changes?feed=longpoll', '_changes?feed=continuous'])
+    eq(s._scheduler.active, 1)
+
+
+def test_token_bucket():
+    bucket = trombi.client.TokenBucket(10, 20)
+    eq(bucket.delay(20), 0)
+    bucket.take(25)
+    # In debt: 5 tokens to pay back and 1 to take
+    assert 0.5 < bucket.delay(1) <= 0.6
+    # More than the capacity only needs a full bucket
+    assert bucket.delay(100) <= 2.5
+
+
+@with_ioloop
+def test_rate_limit(ioloop):
+    s = trombi.Server('http://1.2.3.4', io_loop=ioloop,
+                      rate_limit=trombi.RateLimit(requests=100, burst=0.02,
+                                                  io_loop=ioloop))
+    s._client = client = _RecordingClient()
+    limit = trombi.RateLimit(bytes=1000, io_loop=ioloop)
+    db = trombi.Database(s, 'foobar').with_options(rate_limit=limit)
+
+    db.set('a', {'data': 'x' * 2000}, None)
+    db.set('b', {'data': 'y'}, None)
+    # The first one used up the byte budget, the second waits
+    eq(len(client.requests), 1)
+    eq(limit.waiting, 1)
+
+    def _check():
+        eq(len(client.requests), 2)
+        eq(limit.waiting, 0)
+        eq(limit.delayed, 1)
+        assert limit.waited > 0.5
+        ioloop.stop()
+
+    ioloop.add_timeout(time.time() + 1.5, _check)
+    ioloop.start()
+
+
+@with_ioloop
+def test_circuit_breaker(ioloop):
+    s = trombi.Server('http://1.2.3.4', io_loop=ioloop, breaker_threshold=2,
+                      breaker_reset=0.1)
+    s._client = client = _RecordingClient()
+    db = trombi.Database(s, 'foobar')
+    results = []
+
+    def _answer(index, code):
+        client.callbacks[index](trombi.client._Response(code, None))
+
+    db.get('a', results.append)
+    db.get('b', results.append)
+    _answer(0, 599)
+    _answer(1, 599)
+    eq([r.errno for r in results], [599, 599])
+
+    def _rejected():
+        # Failed without a request
+        eq(len(client.requests), 2)
+        eq(results[-1].errno, trombi.errors.CIRCUIT_OPEN)
+        eq(results[-1].msg, 'Circuit open for http://1.2.3.4')
+        ioloop.add_timeout(time.time() + 0.2, _half_open)
+
+    def _half_open():
+        # One trial request is let through
+        db.get('c', results.append)
+        db.get('d', results.append)
+        eq(len(client.requests), 3)
+        _answer(2, 404)
+        # A missing document is not a failure
+        eq(results[-1], None)
+        ioloop.add_callback(_closed)
+
+    def _closed():
+        eq(results[-1].errno, trombi.errors.CIRCUIT_OPEN)
+        db.get('e', results.append)
+        eq(len(client.requests), 4)
+        ioloop.stop()
+
+    db.get('c', results.append)
+    ioloop.add_callback(_rejected)
+    ioloop.start()
+
+
+def test_circuit_breaker_cancelled_trial():
+    s = trombi.Server('http://1.2.3.4', max_concurrent=1,
+                      breaker_threshold=1, breaker_reset=0)
+    s._client = client = _RecordingClient()
+    db = trombi.Database(s, 'foobar')
+    results = []
+
+    db.get('a', results.append)
+    db.get('b', results.append)
+    client.callbacks[0](trombi.client._Response(599, None))
+    breaker = s._breakers['http://1.2.3.4']
+    eq(breaker.state, 'open')
+    # The trial request waits for the place of b and is cancelled
+    db.get('c', results.append).cancel()
+    eq(breaker.state, 'half-open')
+    client.callbacks[1](trombi.client._Response(599, None))
+    eq(len(client.requests), 2)
+    # The cancelled trial gave its place back to the next one
+    eq(breaker._trials, 0)
+    db.get('d', results.append)
+    eq(len(client.requests), 3)
+    eq(len(results), 2)
+
+
+def test_request_deadline():
+    s = trombi.Server('http://1.2.3.4', max_concurrent=1,
+                      fetch_args={'request_timeout': 60})
+    s._client = client = _RecordingClient()
+    db = trombi.Database(s, 'foobar').with_options(timeout=30)
+    results = []
+
+    db.get('a', results.append)
+    url, kwargs = client.requests[0]
+    assert 29 < kwargs['request_timeout'] <= 30
+
+    # Waits in the scheduler past the deadline
+    late = trombi.Database(s, 'foobar').with_options(deadline=time.time())
+    late.get('b', results.append)
+    client.callbacks[0](trombi.client._Response(404, b''))
+    eq(len(client.requests), 1)
+    eq(results[0].errno, trombi.errors.DEADLINE_EXCEEDED)
+    eq(results[0].msg, 'Deadline exceeded')
+    eq(results[1], None)
+    eq(s._scheduler.active, 0)
+
+
+@with_ioloop
+def test_request_deadline_queued(ioloop):
+    limit = trombi.RateLimit(requests=1, io_loop=ioloop)
+    s = trombi.Server('http://1.2.3.4', io_loop=ioloop, max_concurrent=1)
+    s._client = client = _RecordingClient()
+    db = trombi.Database(s, 'foobar')
+    limited = db.with_options(rate_limit=limit)
+    results = []
+
+    # Take the only place of the scheduler and the only token
+    db.get('a', results.append)
+    limited.get('b', results.append)
+    # Fail at the deadline while waiting for a token or a place
+    limited.with_options(timeout=0.1).get('c', results.append)
+    db.with_options(timeout=0.1).get('d', results.append)
+    # Cancelled while waiting for a token
+    limited.get('e', results.append).cancel()
+
+    def _expired():
+        eq([x.errno for x in results], [trombi.errors.DEADLINE_EXCEEDED] * 2)
+        eq(sum(len(x) for x in s._scheduler._queues.values()), 1)
+        eq(limit.waiting, 1)
+        ioloop.add_timeout(time.time() + 1, _cancelled)
+
+    def _cancelled():
+        # Let go without taking the token
+        eq(limit.waiting, 0)
+        eq(limit.delayed, 0)
+        eq(limit._requests.delay(1), 0)
+        eq(len(client.requests), 1)
+        eq(len(results), 2)
+        ioloop.stop()
+
+    ioloop.add_timeout(time.time() + 0.3, _expired)
+    ioloop.start()
+
+
+def test_request_cancel():
+    s = trombi.Server('http://1.2.3.4', max_concurrent=1)
+    s._client = client = _RecordingClient()
+    db = trombi.Database(s, 'foobar')
+    results = []
+
+    first = db.get('a', results.append)
+    second = db.get('b', results.append)
+    # Cancelled while waiting, never sent
+    second.cancel()
+    # Cancelled in flight, aborted on the next chunk
+    first.cancel()
+    url, kwargs = client.requests[0]
+    try:
+        kwargs['streaming_callback'](b'{')
+    except trombi.client.RequestCancelledError:
+        pass
+    else:
+        assert False, 'Expected the request to be aborted'
+    client.callbacks[0](trombi.client._Response(599, None))
+    eq(len(client.requests), 1)
+    eq(results, [])
+    eq(s._scheduler.active, 0)
+
+
+def test_latency_tracker():
+    tracker = trombi.client.LatencyTracker(window=100, min_samples=10)
+    for i in range(9):
+        tracker.add(i)
+    eq(tracker.percentile(50), None)
+    for i in range(9, 100):
+        tracker.add(i)
+    eq(tracker.percentile(50), 50)
+    eq(tracker.percentile(95), 94)
+    eq(tracker.percentile(100), 99)
+
+
+@with_ioloop
+def test_hedged_reads(ioloop):
+    s = trombi.Server('http://1.2.3.4', io_loop=ioloop,
+                      replicas=['http://5.6.7.8/'], hedge_budget=0.5)
+    s._client = client = _RecordingClient()
+    db = trombi.Database(s, 'foobar')
+    tracker = s._hedger.tracker('get')
+    for i in range(20):
+        tracker.add(0.01)
+    results = []
+
+    # The budget allows one of the two reads to be hedged
+    db.get('a', results.append)
+    db.get('b', results.append)
+
+    def _hedged():
+        eq([url for url, kwargs in client.requests],
+           ['http://1.2.3.4/foobar/a', 'http://1.2.3.4/foobar/b',
+            'http://5.6.7.8/foobar/a'])
+        # The hedge wins and the primary is aborted
+        client.requests[2][1]['streaming_callback'](b'{"_id": "a"}')
+        client.callbacks[2](trombi.client._Response(200, None))
+        eq(results[0].id, 'a')
+        try:
+            client.requests[0][1]['streaming_callback'](b'{')
+        except trombi.client.RequestCancelledError:
+            pass
+        else:
+            assert False, 'Expected the request to be aborted'
+        client.callbacks[0](trombi.client._Response(599, None))
+        client.callbacks[1](trombi.client._Response(404, b''))
+        eq(len(results), 2)
+        eq(results[1], None)
+        eq(s._hedger.tracker('get').percentile(50), 0.01)
+        # The hedge's latency counts from when the read was issued
+        assert tracker._samples[-2] >= 0.1
+        ioloop.stop()
+
+    ioloop.add_timeout(time.time() + 0.1, _hedged)
+    ioloop.start()
+
+
 @with_ioloop
 def test_cannot_connect(ioloop):
     def create_callback(db):
@@ -1109,6 +1425,97 @@ def test_load_view_with_keys(baseurl, ioloop):
     ioloop.start()
 
 
+@with_ioloop
+@with_couchdb
+def test_load_view_with_keys_in_chunks(baseurl, ioloop):
+    keys = ['e', 'missing', 'a', 'd', 'b', 'c', 'a']
+
+    def do_test(db):
+        def create_view_callback(response):
+            eq(response.code, 201)
+            db.bulk_docs([{'data': x} for x in 'abcde'], create_docs_cb)
+
+        def create_docs_cb(result):
+            eq(result.error, False)
+            db.view('testview', 'all', load_view_cb, keys=keys)
+
+        def load_view_cb(result):
+            eq(result.error, False)
+            eq(result.total_rows, 5)
+            eq([x['key'] for x in result], ['e', 'a', 'd', 'b', 'c', 'a'])
+            db.view('testview', 'all', load_limited_view_cb, keys=keys,
+                    skip=1, limit=3)
+
+        def load_limited_view_cb(result):
+            eq(result.error, False)
+            eq([x['key'] for x in result], ['a', 'd', 'b'])
+            ioloop.stop()
+
+        db.server._fetch(
+            '%stestdb/_design/testview' % baseurl,
+            create_view_callback,
+            method='PUT',
+            body=json.dumps(
+                {
+                    'language': 'javascript',
+                    'views': {
+                        'all': {
+                            'map': 'function (doc) { emit(doc.data, doc) }',
+                            }
+                        }
+                    }
+                )
+            )
+
+    s = trombi.Server(baseurl, io_loop=ioloop, keys_chunk_size=2,
+                      keys_concurrency=2)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_load_grouped_view_with_keys_in_chunks(baseurl, ioloop):
+    def do_test(db):
+        def create_view_callback(response):
+            eq(response.code, 201)
+            db.bulk_docs([{'data': x} for x in 'abcdea'], create_docs_cb)
+
+        def create_docs_cb(result):
+            eq(result.error, False)
+            db.view('testview', 'count', load_view_cb, keys=list('abcde'),
+                    group=True)
+
+        def load_view_cb(result):
+            eq(result.error, False)
+            eq(result.total_rows, 5)
+            eq([(x['key'], x['value']) for x in result],
+               [('a', 2), ('b', 1), ('c', 1), ('d', 1), ('e', 1)])
+            ioloop.stop()
+
+        db.server._fetch(
+            '%stestdb/_design/testview' % baseurl,
+            create_view_callback,
+            method='PUT',
+            body=json.dumps(
+                {
+                    'language': 'javascript',
+                    'views': {
+                        'count': {
+                            'map': 'function (doc) { emit(doc.data, 1) }',
+                            'reduce': '_count',
+                            }
+                        }
+                    }
+                )
+            )
+
+    s = trombi.Server(baseurl, io_loop=ioloop, keys_chunk_size=2,
+                      keys_concurrency=2)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
 @with_ioloop
 @with_couchdb
 def test_load_view_no_design_doc(baseurl, ioloop):
@@ -1796,3 +2203,634 @@ def test_create_document_with_custom_encoder(baseurl, ioloop):
     s = trombi.Server(baseurl, io_loop=ioloop, json_encoder=DatetimeEncoder)
     s.create('testdb', callback=create_db_callback)
     ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_follow_changes_with_docs(baseurl, ioloop):
+    changes = []
+
+    def do_test(db):
+        def _got_change(change):
+            changes.append(change)
+            if len(changes) == 2:
+                follower.stop()
+                ioloop.stop()
+
+        def docs_created(response):
+            assert not response.error
+            follower.start()
+
+        follower = trombi.ChangesFollower(
+            db, _got_change,
+            predicate=lambda row: row['id'] != 'skipped',
+            include_docs=True,
+            chunk_size=1,
+            )
+        db.bulk_docs([
+                {'_id': 'first', 'some': 'data'},
+                {'_id': 'skipped', 'some': 'other'},
+                {'_id': 'second', 'more': 'data'},
+                ], docs_created)
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+    eq([x['id'] for x in changes], ['first', 'second'])
+    assert all(isinstance(x['doc'], trombi.Document) for x in changes)
+    eq(changes[0]['doc']['some'], 'data')
+    eq(changes[1]['doc']['more'], 'data')
+
+
+@with_ioloop
+def test_follow_changes_retry(ioloop):
+    results = []
+    s = trombi.Server('http://127.0.0.1:1', io_loop=ioloop)
+    db = trombi.Database(s, 'testdb')
+    follower = db.follow_changes(results.append, retry_delay=0.01)
+    ioloop.add_timeout(time.time() + 0.2, ioloop.stop)
+    ioloop.start()
+    # Connection errors are retried instead of ending the follower
+    eq(results, [])
+    assert follower.running
+    follower.stop()
+    eq(follower._retry_timeout, None)
+
+
+@with_ioloop
+@with_couchdb
+def test_shared_changes_feed(baseurl, ioloop):
+    first = []
+    second = []
+
+    def do_test(db):
+        feed = db.changes_feed()
+        assert trombi.Database(s, 'testdb').changes_feed() is feed
+
+        def _got_first(change):
+            first.append(change['id'])
+
+        def _got_second(change):
+            second.append(change['id'])
+            if change['id'] == 'third_doc':
+                ioloop.stop()
+
+        def doc_created(response):
+            assert not response.error
+            feed.subscribe(
+                _got_second,
+                since=0,
+                predicate=lambda change: change['id'] != 'second_doc',
+                )
+            db.set('third_doc', {'still': 'more'}, lambda x: None)
+
+        feed.subscribe(_got_first)
+        db.bulk_docs([{'_id': 'mydoc'}, {'_id': 'second_doc'}],
+                     doc_created)
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+    eq(first, ['mydoc', 'second_doc', 'third_doc'])
+    eq(second, ['mydoc', 'third_doc'])
+
+
+def test_changes_subscription_catch_up():
+    seqs = []
+    s = trombi.Server('http://127.0.0.1:1')
+    feed = trombi.Database(s, 'testdb').changes_feed()
+    subscription = trombi.ChangesSubscription(
+        feed, lambda change: seqs.append(change['seq']))
+
+    def change(seq):
+        return trombi.TrombiDict({'seq': seq, 'id': 'doc%d' % seq,
+                                  'changes': []})
+
+    # Live changes queued while the catch-up request is made
+    subscription._pending = []
+    subscription._push(change(5))
+    subscription._push(change(6))
+    # The catch-up reaches further than the live feed
+    subscription._caught_up(trombi.TrombiResult({
+                'results': [change(x) for x in range(2, 8)],
+                'last_seq': 7,
+                }))
+    subscription._push(change(7))
+    subscription._push(change(8))
+    eq(seqs, [2, 3, 4, 5, 6, 7, 8])
+    eq(subscription.since, 8)
+    eq(trombi.client._seq_number('12-g1AAAA'), 12)
+    eq(trombi.client._seq_number([12, 'g1AAAA']), 12)
+
+
+def test_changes_feed_restart():
+    seqs = []
+    s = trombi.Server('http://1.2.3.4')
+    s._client = client = _RecordingClient()
+    feed = trombi.Database(s, 'testdb').changes_feed(filter='ddoc/f')
+
+    def change(seq):
+        return trombi.TrombiDict({'seq': seq, 'id': 'doc%d' % seq,
+                                  'changes': []})
+
+    subscription = feed.subscribe(lambda change: None, since=0)
+    for seq in range(1, 11):
+        feed._got_change(change(seq))
+    subscription.unsubscribe()
+
+    # Restarted further on, the changes of the first run are stale
+    feed.subscribe(lambda change: None, since=50)
+    for seq in range(51, 54):
+        feed._got_change(change(seq))
+    feed.subscribe(lambda change: seqs.append(change['seq']), since=5)
+    eq(seqs, [])
+    # The catch-up uses the same filter as the feed
+    url, kwargs = client.requests[-1]
+    assert url.endswith('_changes?since=5&filter=ddoc%2Ff&feed=normal'), url
+
+
+def test_changes_feed_heartbeat():
+    s = trombi.Server('http://1.2.3.4')
+    s._client = client = _RecordingClient()
+    feed = trombi.Database(s, 'testdb').changes_feed(heartbeat=5)
+    subscription = feed.subscribe(lambda change: None)
+    url, kwargs = client.requests[0]
+    assert 'heartbeat=5000' in url, url
+
+    # The heartbeat of an idle feed aborts the request once cancelled
+    subscription.unsubscribe()
+    try:
+        kwargs['streaming_callback'](b'\n')
+    except trombi.client.RequestCancelledError:
+        pass
+    else:
+        assert False, 'Expected the request to be aborted'
+
+
+class _CountingLoader(trombi.BulkLoader):
+    decoded = 0
+
+    def _doc_id(self, doc):
+        self.decoded += 1
+        return super(_CountingLoader, self)._doc_id(doc)
+
+
+def test_bulk_load_replicated_docs():
+    errors = []
+    s = trombi.Server('http://1.2.3.4')
+    s._client = client = _RecordingClient()
+    db = trombi.Database(s, 'testdb')
+    docs = [('{"_id":"doc%d","_rev":"1-a"}' % i).encode('utf-8')
+            for i in range(10)]
+    loader = _CountingLoader(
+        db, docs, lambda loader: None, chunk_size=5, concurrency=1,
+        on_error=lambda doc, error: errors.append(error.error_type),
+        new_edits=False)
+    loader.start()
+
+    def _answer(number, body):
+        client.requests[number][1]['streaming_callback'](body)
+        client.callbacks[number](trombi.client._Response(201, b''))
+
+    # The serialized documents aren't looked at without failures
+    _answer(0, b'[]')
+    eq(loader.loaded, 5)
+    eq(loader.decoded, 0)
+
+    # ... and only until the failures are found
+    _answer(1, b'[{"id":"doc6","error":"forbidden","reason":"No"}]')
+    eq(loader.loaded, 9)
+    eq(errors, ['forbidden'])
+    eq(loader.decoded, 2)
+
+
+@with_ioloop
+@with_couchdb
+def test_bulk_load(baseurl, ioloop):
+    errors = []
+    progress = []
+
+    def generate_docs():
+        for i in range(25):
+            yield {'_id': 'doc%02d' % i, 'value': i}
+        yield {'_id': 'doc03', 'value': 'conflicting'}
+
+    def do_test(db):
+        def _on_error(doc, error):
+            errors.append((doc['_id'], error.error_type))
+
+        def bulk_loaded(loader):
+            eq(loader.error, False)
+            eq(loader.loaded, 25)
+            eq(loader.failed, 1)
+            db.view(None, '_all_docs', view_cb)
+
+        def view_cb(result):
+            eq(len(result), 25)
+            ioloop.stop()
+
+        db.bulk_load(generate_docs(), bulk_loaded,
+                     chunk_size=10, concurrency=2,
+                     on_error=_on_error, progress=progress.append)
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+    eq(errors, [('doc03', 'conflict')])
+    eq(progress[-1], 26)
+
+
+@with_ioloop
+@with_couchdb
+def test_get_document_raw(baseurl, ioloop):
+    def do_test(db):
+        def create_doc_callback(doc):
+            db.get(doc.id, get_doc_callback, raw=True)
+
+        def get_doc_callback(result):
+            eq(result.error, False)
+            assert isinstance(result.content, bytes)
+            data = json.loads(result.content.decode('utf-8'))
+            eq(data['_id'], 'testid')
+            eq(data['testvalue'], 'something')
+            ioloop.stop()
+
+        db.set('testid', {'testvalue': 'something'}, create_doc_callback)
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_load_view_raw(baseurl, ioloop):
+    def do_test(db):
+        def create_doc_callback(doc):
+            db.view(None, '_all_docs', view_callback, raw=True,
+                    include_docs=True)
+
+        def view_callback(result):
+            eq(result.error, False)
+            data = json.loads(result.content.decode('utf-8'))
+            eq(data['total_rows'], 1)
+            eq(data['rows'][0]['doc']['testvalue'], 'something')
+            ioloop.stop()
+
+        db.set('testid', {'testvalue': 'something'}, create_doc_callback)
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_continuous_changes_feed_raw(baseurl, ioloop):
+    def do_test(db):
+        def _got_change(change):
+            eq(change.error, False)
+            data = json.loads(change.content.decode('utf-8'))
+            eq(data['id'], 'mydoc')
+            ioloop.stop()
+
+        def doc_created(response):
+            assert not response.error
+            db.changes(_got_change, feed='continuous', raw=True)
+
+        db.set('mydoc', {'some': 'data'}, doc_created)
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_decode_in_executor(baseurl, ioloop):
+    try:
+        from concurrent.futures import ThreadPoolExecutor
+    except ImportError:
+        from nose.plugins.skip import SkipTest
+        raise SkipTest('concurrent.futures is not available')
+
+    def do_test(db):
+        def bulks_cb(response):
+            assert not response.error
+            eq(len(response), 2)
+            db.view(None, '_all_docs', view_cb, include_docs=True)
+
+        def view_cb(result):
+            eq(result.error, False)
+            eq(len(result), 2)
+            eq(result[0]['doc']['key1'], 'data1')
+            ioloop.stop()
+
+        datas = [
+            {'_id': 'doc1', 'key1': 'data1'},
+            {'_id': 'doc2', 'key2': 'data2'},
+            ]
+        db.bulk_docs(datas, bulks_cb)
+
+    executor = ThreadPoolExecutor(1)
+    s = trombi.Server(baseurl, io_loop=ioloop, executor=executor,
+                      executor_threshold=0, executor_bulk_docs=1)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+    executor.shutdown()
+
+
+@with_ioloop
+def test_executor_error(ioloop):
+    try:
+        from concurrent.futures import ThreadPoolExecutor
+    except ImportError:
+        from nose.plugins.skip import SkipTest
+        raise SkipTest('concurrent.futures is not available')
+
+    results = []
+
+    def bulks_cb(response):
+        results.append(response)
+        ioloop.stop()
+
+    executor = ThreadPoolExecutor(1)
+    s = trombi.Server('http://127.0.0.1:1', io_loop=ioloop,
+                      executor=executor, executor_bulk_docs=1)
+    db = trombi.Database(s, 'testdb')
+    # Not serializable, the request is never sent
+    db.bulk_docs([{'_id': 'doc1', 'value': object()}], bulks_cb)
+    ioloop.start()
+    executor.shutdown()
+    eq(results[0].error, True)
+    eq(results[0].errno, trombi.errors.EXECUTOR_ERROR)
+
+
+@with_ioloop
+@with_couchdb
+def test_update_document_with_conflicts(baseurl, ioloop):
+    metrics = []
+
+    def increment(doc):
+        if doc is None:
+            return {'count': 1}
+        data = dict(doc)
+        data['count'] += 1
+        return data
+
+    def do_test(db):
+        results = []
+
+        def updated(doc):
+            eq(doc.error, False)
+            results.append(doc['count'])
+            if len(results) == 3:
+                eq(sorted(results), [1, 2, 3])
+                db.get('counter', get_callback)
+
+        def get_callback(doc):
+            eq(doc['count'], 3)
+            ioloop.stop()
+
+        for i in range(3):
+            db.update('counter', increment, updated)
+
+    def _metric(name, value):
+        metrics.append((name, value))
+
+    s = trombi.Server(baseurl, io_loop=ioloop, metrics=_metric)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+    assert ('update.conflict', 1) in metrics
+    eq(len([x for x in metrics if x[0] == 'update.retries']), 3)
+
+
+@with_ioloop
+@with_couchdb
+def test_update_document_no_change(baseurl, ioloop):
+    def do_test(db):
+        def create_doc_callback(doc):
+            db.update(doc, lambda doc: None, updated)
+
+        def updated(doc):
+            eq(doc.error, False)
+            assert doc.rev.startswith('1-')
+            ioloop.stop()
+
+        db.set('testid', {'testvalue': 'something'}, create_doc_callback)
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
+def _create_counter_handler(db, callback):
+    db.server._fetch(
+        '%s/_design/counter' % db.baseurl,
+        callback,
+        method='PUT',
+        body=json.dumps(
+            {
+                'language': 'javascript',
+                'updates': {
+                    'increment': '''function (doc, req) {
+                        if (!doc) { doc = {_id: req.id, count: 0}; }
+                        doc.count += parseInt(req.query.by || "1");
+                        return [doc, String(doc.count)];
+                    }''',
+                    }
+                }
+            )
+        )
+
+
+@with_ioloop
+@with_couchdb
+def test_update_handler(baseurl, ioloop):
+    def do_test(db):
+        def handler_created(response):
+            eq(response.code, 201)
+            db.update_handler('counter', 'increment', updated,
+                              doc_id='hits', by=5)
+
+        def updated(result):
+            eq(result.error, False)
+            eq(result.content, b'5')
+            assert result.rev.startswith('1-')
+            ioloop.stop()
+
+        _create_counter_handler(db, handler_created)
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_update_coalescer(baseurl, ioloop):
+    results = []
+
+    def do_test(db):
+        def handler_created(response):
+            eq(response.code, 201)
+            coalescer = trombi.UpdateCoalescer(db, 'counter', 'increment')
+            for i in range(3):
+                coalescer.increment('hits', updated, amount=2)
+
+        def updated(result):
+            eq(result.error, False)
+            results.append(result.content)
+            if len(results) == 3:
+                db.get('hits', get_callback)
+
+        def get_callback(doc):
+            eq(doc['count'], 6)
+            assert doc.rev.startswith('1-')
+            ioloop.stop()
+
+        _create_counter_handler(db, handler_created)
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+    eq(results, [b'6', b'6', b'6'])
+
+
+def test_sequential_uuids():
+    uuids = trombi.SequentialUUIDs()
+    results = []
+    uuids.get(3, results.append)
+    ids = results[0].content
+    eq(len(ids), 3)
+    assert all(len(x) == 32 for x in ids)
+    eq(len(set(x[:26] for x in ids)), 1)
+    eq(sorted(ids), ids)
+
+
+@with_ioloop
+@with_couchdb
+def test_create_document_with_uuid_pool(baseurl, ioloop):
+    def do_test(db):
+        def create_doc_callback(doc):
+            eq(doc.error, False)
+            eq(len(doc.id), 32)
+            eq(len(s._uuids._ids), 9)
+            ioloop.stop()
+
+        db.set({'testvalue': 'something'}, create_doc_callback)
+
+    s = trombi.Server(baseurl, io_loop=ioloop, uuids='server', uuid_batch=10)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_bulk_insert_with_sequential_uuids(baseurl, ioloop):
+    def do_test(db):
+        datas = [
+            {'key1': 'data1'},
+            trombi.Document(db, {'key2': 'data2'}),
+            {'_id': 'fixed', 'key3': 'data3'},
+            ]
+
+        def bulks_cb(response):
+            assert not response.error
+            eq([x['id'] for x in response],
+               [datas[0]['_id'], datas[1].id, 'fixed'])
+            assert datas[0]['_id'] < datas[1].id
+            ioloop.stop()
+
+        db.bulk_docs(datas, bulks_cb)
+
+    s = trombi.Server(baseurl, io_loop=ioloop, uuids='sequential')
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_gzip_request_bodies(baseurl, ioloop):
+    metrics = []
+
+    def do_test(db):
+        def bulks_cb(response):
+            assert not response.error
+            db.get('big', get_cb)
+
+        def get_cb(doc):
+            eq(doc['text'], 'x' * 2000)
+            names = [name for name, value in metrics]
+            eq(names, ['gzip.request_time', 'gzip.request_ratio'])
+            assert metrics[1][1] < 0.1
+            ioloop.stop()
+
+        db.bulk_docs([{'_id': 'big', 'text': 'x' * 2000}], bulks_cb)
+
+    s = trombi.Server(baseurl, io_loop=ioloop, gzip_threshold=1024,
+                      metrics=lambda name, value: metrics.append(
+                          (name, value)))
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_cookie_session(baseurl, ioloop):
+    metrics = []
+
+    def user_created(response):
+        # The user is left over from an earlier run, if 409
+        assert response.code in (201, 409)
+        s.create('testdb', callback=do_test)
+
+    def do_test(db):
+        def create_doc_callback(doc):
+            eq(doc.error, False)
+            session_db.get(doc.id, get_doc_callback)
+
+        def get_doc_callback(doc):
+            eq(doc.error, False)
+            eq(doc['testvalue'], 'something')
+            eq(metrics, ['session.login'])
+            assert session_server._session.cookie
+            ioloop.stop()
+
+        session_server = trombi.Server(
+            baseurl, io_loop=ioloop, session=('trombi', 'secret'),
+            metrics=lambda name, value: metrics.append(name))
+        session_db = trombi.Database(session_server, 'testdb')
+        session_db.set({'testvalue': 'something'}, create_doc_callback)
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s._fetch(
+        '%s_users/org.couchdb.user:trombi' % baseurl,
+        user_created,
+        method='PUT',
+        body=json.dumps({
+                'name': 'trombi',
+                'password': 'secret',
+                'roles': [],
+                'type': 'user',
+                }),
+        )
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_cookie_session_bad_password(baseurl, ioloop):
+    def do_test(db):
+        def info_callback(result):
+            eq(result.error, True)
+            eq(result.errno, 401)
+            ioloop.stop()
+
+        session_server = trombi.Server(
+            baseurl, io_loop=ioloop, session=('nobody', 'wrong'))
+        trombi.Database(session_server, 'testdb').info(info_callback)
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
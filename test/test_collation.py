@@ -0,0 +1,91 @@
+# Copyright (c) 2011 Jyrki Pulliainen <jyrki@dywypi.org>
+# Copyright (c) 2010 Inoi Oy
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import random
+
+from nose.tools import eq_ as eq
+from .util import assert_raises
+
+from trombi.collation import collation_key, compare, validate_range, \
+    ViewIndex
+
+
+def test_collation_order():
+    # The example from the CouchDB view collation documentation
+    values = [
+        None, False, True,
+        1, 2, 3.0, 4,
+        'a', 'A', 'aa', 'b', 'B', 'ba', 'bb',
+        ['a'], ['b'], ['b', 'c'], ['b', 'c', 'a'], ['b', 'd'],
+        ['b', 'd', 'e'],
+        {'a': 1}, {'a': 2}, {'b': 1}, {'b': 2}, {'b': 2, 'a': 1},
+        {'b': 2, 'c': 2},
+        ]
+    shuffled = values[:]
+    random.shuffle(shuffled)
+    eq(sorted(shuffled, key=collation_key), values)
+
+
+def test_collation_strings():
+    eq(sorted([u'\xe9', u'f', u'E', u'e', u'1', u'-', u' '],
+              key=collation_key),
+       [u' ', u'-', u'1', u'e', u'E', u'\xe9', u'f'])
+
+
+def test_compare():
+    eq(compare(1, 1.0), 0)
+    eq(compare([1], [1, 0]), -1)
+    eq(compare({'a': 1}, None), 1)
+
+
+def test_validate_range():
+    validate_range(1, 2)
+    validate_range(2, 1, descending=True)
+    assert_raises(ValueError, validate_range, 'b', 'a')
+    assert_raises(ValueError, validate_range, 'a', 'b', descending=True)
+
+
+def test_view_index_range():
+    rows = [{'key': key, 'id': 'doc%d' % i}
+            for i, key in enumerate([1, 2, 2, 2, 3, 4])]
+    index = ViewIndex(reversed(rows))
+
+    def ids(**kwargs):
+        return [row['id'] for row in index.range(**kwargs)]
+
+    eq(len(index), 6)
+    eq(ids(), ['doc0', 'doc1', 'doc2', 'doc3', 'doc4', 'doc5'])
+    eq(ids(startkey=2, endkey=3), ['doc1', 'doc2', 'doc3', 'doc4'])
+    eq(ids(startkey=2, endkey=3, inclusive_end=False),
+       ['doc1', 'doc2', 'doc3'])
+    eq(ids(startkey=2, startkey_docid='doc2', endkey=2,
+           endkey_docid='doc2'), ['doc2'])
+    eq(ids(startkey=3, endkey=2, descending=True),
+       ['doc4', 'doc3', 'doc2', 'doc1'])
+    eq(ids(startkey=3, endkey=2, descending=True, inclusive_end=False),
+       ['doc4'])
+    eq(ids(skip=1, limit=2), ['doc1', 'doc2'])
+
+    index.discard('doc2')
+    eq(ids(startkey=2, endkey=2), ['doc1', 'doc3'])
@@ -0,0 +1,95 @@
+# Copyright (c) 2011 Jyrki Pulliainen <jyrki@dywypi.org>
+# Copyright (c) 2010 Inoi Oy
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from nose.tools import eq_ as eq
+from .couch_util import setup, teardown, with_couchdb
+from .test_sharding import _create_shards
+from .util import with_ioloop
+
+import trombi
+from trombi.merge import ViewSource, merge_views
+
+KEYS = [None, False, True, 0, 1.5, 'a', 'b', [1], [1, 2], {'a': 1}]
+
+
+def _load(ioloop, databases, count):
+    pending = [len(databases)]
+
+    def bulk_done(result):
+        assert not result.error
+        pending[0] -= 1
+        if pending[0] == 0:
+            ioloop.stop()
+
+    for n, db in enumerate(databases):
+        docs = [{'_id': 'doc%02d' % i, 'key': KEYS[i % len(KEYS)]}
+                for i in range(count) if i % len(databases) == n]
+        db.bulk_docs(docs, bulk_done)
+    ioloop.start()
+
+
+def _merge(ioloop, databases, **kwargs):
+    results = []
+
+    def merged(result):
+        results.append(result)
+        ioloop.stop()
+
+    merge_views(databases, 'test', 'by_key', merged, **kwargs)
+    ioloop.start()
+    return results[0]
+
+
+@with_ioloop
+@with_couchdb
+def test_merge_views(baseurl, ioloop):
+    databases = _create_shards(ioloop, baseurl, 3)
+    _load(ioloop, databases, 30)
+
+    expected = sorted(['doc%02d' % i for i in range(30)],
+                      key=lambda x: (int(x[3:]) % len(KEYS), x))
+
+    result = _merge(ioloop, databases, page_size=4)
+    eq(result.total_rows, 30)
+    eq([row['id'] for row in result], expected)
+    eq([row['key'] for row in result][::3], KEYS)
+
+    result = _merge(ioloop, databases, page_size=4, descending=True)
+    eq([row['id'] for row in result], expected[::-1])
+
+    result = _merge(ioloop, databases, skip=5, limit=4)
+    eq([row['id'] for row in result], expected[5:9])
+
+
+def test_view_source_reduce():
+    db = trombi.Database(trombi.Server('http://127.0.0.1:1'), 'testdb')
+    eq(ViewSource(db, 'test', 'by_key')._params, {'reduce': False})
+    eq(ViewSource(db, None, '_all_docs')._params, {})
+    for kwargs in [{'reduce': True}, {'group': True}, {'group_level': 1}]:
+        try:
+            merge_views([db], 'test', 'by_key', lambda x: None, **kwargs)
+        except TypeError:
+            pass
+        else:
+            assert False, 'Expected TypeError for %r' % kwargs
@@ -0,0 +1,178 @@
+# Copyright (c) 2011 Jyrki Pulliainen <jyrki@dywypi.org>
+# Copyright (c) 2010 Inoi Oy
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+
+from nose.tools import eq_ as eq, assert_raises
+from .couch_util import setup, teardown, with_couchdb
+from .test_client import _RecordingClient
+from .util import with_ioloop
+
+import trombi
+from trombi.sharding import ShardedDatabase
+
+
+def _create_shards(ioloop, baseurl, count):
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    databases = []
+    design_doc = {
+        'language': 'javascript',
+        'views': {
+            'by_key': {
+                'map': 'function (doc) { emit(doc.key, doc.value); }',
+                },
+            },
+        }
+
+    def design_doc_created(doc):
+        assert not doc.error
+        databases.append(doc.db)
+        if len(databases) == count:
+            ioloop.stop()
+
+    def db_created(db):
+        assert not db.error
+        db.set('_design/test', design_doc, design_doc_created)
+
+    for i in range(count):
+        s.create('shard%d' % i, callback=db_created)
+    ioloop.start()
+    databases.sort(key=lambda db: db.name)
+    return databases
+
+
+def test_routing_is_stable():
+    s = trombi.Server('http://localhost:5984')
+    databases = [trombi.Database(s, 'shard%d' % i) for i in range(4)]
+    sharded = ShardedDatabase(databases)
+    ids = ['doc%d' % i for i in range(200)]
+    before = dict((doc_id, sharded.shard(doc_id).name) for doc_id in ids)
+    eq(len(set(before.values())), 4)
+
+    # Adding a shard only moves documents to the new shard
+    grown = ShardedDatabase(databases + [trombi.Database(s, 'shard4')])
+    for doc_id in ids:
+        name = grown.shard(doc_id).name
+        assert name in (before[doc_id], 'shard4')
+
+
+def test_sharded_serialized_docs():
+    s = trombi.Server('http://1.2.3.4')
+    s._client = client = _RecordingClient()
+    sharded = ShardedDatabase(
+        [trombi.Database(s, 'shard%d' % i) for i in range(3)])
+    docs = [json.dumps({'_id': 'doc%d' % i}).encode('utf-8')
+            for i in range(10)]
+    sharded.bulk_docs(docs, lambda result: None)
+
+    ids = []
+    for url, kwargs in client.requests:
+        name = url.split('/')[3]
+        for doc in json.loads(kwargs['body'].decode('utf-8'))['docs']:
+            eq(sharded.shard(doc['_id']).name, name)
+            ids.append(doc['_id'])
+    eq(sorted(ids), sorted('doc%d' % i for i in range(10)))
+
+    # Without an id, the database can't be chosen
+    assert_raises(TypeError, sharded.bulk_docs, [b'{"a": 1}'], None)
+
+
+def test_sharded_request_handles():
+    s = trombi.Server('http://1.2.3.4')
+    s._client = client = _RecordingClient()
+    sharded = ShardedDatabase(
+        [trombi.Database(s, 'shard%d' % i) for i in range(3)])
+    assert isinstance(sharded.get('doc', None), trombi.RequestHandle)
+    assert isinstance(sharded.set('doc', {}, None), trombi.RequestHandle)
+
+    # One handle covers the requests made to all the shards
+    bulk = sharded.bulk_docs([{'_id': 'doc%d' % i} for i in range(10)],
+                             None)
+    view = sharded.view('test', 'by_key', None)
+    eq(len(client.requests), 8)
+    bulk.cancel()
+    for url, kwargs in client.requests[2:5]:
+        assert_raises(trombi.RequestCancelledError,
+                      kwargs['streaming_callback'], b'[]')
+    assert not view.cancelled
+    view.cancel()
+    for url, kwargs in client.requests[5:]:
+        assert_raises(trombi.RequestCancelledError,
+                      kwargs['streaming_callback'], b'{}')
+
+
+@with_ioloop
+@with_couchdb
+def test_sharded_documents(baseurl, ioloop):
+    databases = _create_shards(ioloop, baseurl, 3)
+    sharded = ShardedDatabase(databases)
+    results = []
+
+    def got_doc(doc):
+        results.append(doc)
+        ioloop.stop()
+
+    def doc_created(doc):
+        assert not doc.error
+        results.append(doc)
+        sharded.get(doc.id, got_doc)
+
+    sharded.set({'key': 1}, doc_created)
+    ioloop.start()
+
+    created, fetched = results
+    eq(fetched.id, created.id)
+    eq(fetched['key'], 1)
+    eq(fetched.db.name, sharded.shard(created.id).name)
+
+
+@with_ioloop
+@with_couchdb
+def test_sharded_bulk_docs_and_view(baseurl, ioloop):
+    databases = _create_shards(ioloop, baseurl, 3)
+    sharded = ShardedDatabase(databases)
+    docs = [{'_id': 'doc%02d' % i, 'key': i % 5, 'value': i}
+            for i in range(20)]
+    results = []
+
+    def got_view(result):
+        results.append(result)
+        ioloop.stop()
+
+    def bulk_done(result):
+        assert not result.error
+        results.append(result)
+        sharded.view('test', 'by_key', got_view, skip=3, limit=6)
+
+    sharded.bulk_docs(docs, bulk_done)
+    ioloop.start()
+
+    bulk, view = results
+    eq([x['id'] for x in bulk], [doc['_id'] for doc in docs])
+    for db in databases:
+        assert any(sharded.shard(x['id']) is db for x in bulk)
+
+    eq(view.total_rows, 20)
+    eq([(row['key'], row['id']) for row in view],
+       [(0, 'doc15'), (1, 'doc01'), (1, 'doc06'),
+        (1, 'doc11'), (1, 'doc16'), (2, 'doc02')])
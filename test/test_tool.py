@@ -0,0 +1,169 @@
+# Copyright (c) 2011 Jyrki Pulliainen <jyrki@dywypi.org>
+# Copyright (c) 2010 Inoi Oy
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import gzip
+import os
+import shutil
+import tempfile
+
+from nose.tools import eq_ as eq
+from .couch_util import setup, teardown, with_couchdb
+from .util import with_ioloop
+
+import trombi
+import trombi.tool
+
+
+def _run(ioloop, worker_class, db, fobj, **kwargs):
+    results = []
+
+    def _done(worker):
+        results.append(worker)
+        ioloop.stop()
+
+    worker_class(db, fobj, _done, **kwargs).start()
+    ioloop.start()
+    return results[0]
+
+
+@with_ioloop
+@with_couchdb
+def test_export_import(baseurl, ioloop):
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'dump.ndjson.gz')
+    checkpoint = os.path.join(tmp, 'dump.checkpoint')
+    databases = []
+
+    def do_test(db):
+        databases.append(db)
+        if len(databases) == 2:
+            ioloop.stop()
+
+    def docs_created(result):
+        assert not result.error
+        s.create('target', callback=do_test)
+
+    def source_created(db):
+        databases.append(db)
+        docs = [{'_id': 'doc%d' % i, 'value': i} for i in range(5)]
+        # Exported without attachments, the stubs would fail to import
+        docs[0]['_attachments'] = {
+            'note.txt': {'content_type': 'text/plain', 'data': 'aGVsbG8='},
+            }
+        db.bulk_docs(docs, docs_created)
+
+    try:
+        s = trombi.Server(baseurl, io_loop=ioloop)
+        s.create('source', callback=source_created)
+        ioloop.start()
+        source, target = databases
+
+        fobj = gzip.open(path, 'wb')
+        exporter = _run(ioloop, trombi.tool.Exporter, source, fobj,
+                        batch_size=2, checkpoint=checkpoint)
+        fobj.close()
+        eq(exporter.error, None)
+        eq(exporter.exported, 5)
+        fobj = gzip.open(path, 'rb')
+        data = fobj.read()
+        fobj.close()
+        assert b'_attachments' not in data
+        eq(trombi.tool.read_checkpoint(checkpoint),
+           {'last_id': 'doc4', 'offset': len(data)})
+
+        fobj = gzip.open(path, 'rb')
+        importer = _run(ioloop, trombi.tool.Importer, target, fobj,
+                        batch_size=2)
+        fobj.close()
+        eq(importer.imported, 5)
+        eq(importer.failed, 0)
+
+        results = []
+
+        def view_cb(result):
+            results.append(result)
+            ioloop.stop()
+
+        target.view(None, '_all_docs', view_cb, include_docs=True)
+        ioloop.start()
+        eq([row['doc']['value'] for row in results[0]], list(range(5)))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_open_at():
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'dump.ndjson')
+        fobj = open(path, 'wb')
+        fobj.write(b'{"_id": "a"}\n{"_id": "b"}\n{"_id"')
+        fobj.close()
+        fobj = trombi.tool._open_at(path, 26)
+        fobj.write(b'{"_id": "c"}\n')
+        fobj.close()
+        eq(open(path, 'rb').read(),
+           b'{"_id": "a"}\n{"_id": "b"}\n{"_id": "c"}\n')
+
+        # An export interrupted in the middle of a batch leaves a
+        # gzip stream without an end
+        path = os.path.join(tmp, 'dump.ndjson.gz')
+        fobj = gzip.open(path, 'wb')
+        fobj.write(b'{"_id": "a"}\n')
+        fobj.flush()
+        fobj.write(b'{"_id": "b"}\n')
+        fobj.flush()
+        size = os.path.getsize(path)
+        fobj.close()
+        fobj = open(path, 'rb+')
+        fobj.truncate(size)
+        fobj.close()
+
+        fobj = trombi.tool._open_at(path, 13)
+        fobj.write(b'{"_id": "c"}\n')
+        fobj.close()
+        fobj = gzip.open(path, 'rb')
+        eq(fobj.read(), b'{"_id": "a"}\n{"_id": "c"}\n')
+        fobj.close()
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_iter_records():
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'dump.ndjson')
+        fobj = open(path, 'wb')
+        fobj.write(b'{"_id": "a"}\n\n{"_id": "b"}\r\n{"_id": "c"}')
+        fobj.close()
+
+        fobj = open(path, 'rb')
+        eq(list(trombi.tool.iter_records(fobj)),
+           [b'{"_id": "a"}', b'{"_id": "b"}', b'{"_id": "c"}'])
+        fobj.close()
+
+        open(path, 'wb').close()
+        fobj = open(path, 'rb')
+        eq(list(trombi.tool.iter_records(fobj)), [])
+        fobj.close()
+    finally:
+        shutil.rmtree(tmp)
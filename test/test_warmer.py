@@ -0,0 +1,61 @@
+# Copyright (c) 2011 Jyrki Pulliainen <jyrki@dywypi.org>
+# Copyright (c) 2010 Inoi Oy
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from nose.tools import eq_ as eq
+from .couch_util import setup, teardown, with_couchdb
+from .test_sharding import _create_shards
+from .util import with_ioloop
+
+import trombi
+from trombi.warmer import ViewWarmer
+
+
+@with_ioloop
+@with_couchdb
+def test_view_warmer(baseurl, ioloop):
+    db, = _create_shards(ioloop, baseurl, 1)
+
+    def metric(name, value):
+        if name == 'view_warmer.duration':
+            ioloop.stop()
+
+    s = trombi.Server(baseurl, io_loop=ioloop, metrics=metric)
+    db = trombi.Database(s, db.name)
+    # The design document is the first change
+    warmer = ViewWarmer(db, [('test', 'by_key')], changes=2, idle=60,
+                        since=0)
+    warmer.start()
+
+    def doc_created(doc):
+        assert not doc.error
+
+    db.set({'key': 1}, doc_created)
+    ioloop.start()
+    warmer.stop()
+
+    eq(warmer.changes_seen, 2)
+    eq(warmer.warmups, 1)
+    eq(warmer.queries, 1)
+    eq(warmer.failed, 0)
+    assert warmer.last_duration is not None
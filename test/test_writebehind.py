@@ -0,0 +1,133 @@
+# Copyright (c) 2011 Jyrki Pulliainen <jyrki@dywypi.org>
+# Copyright (c) 2010 Inoi Oy
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import shutil
+import tempfile
+
+from nose.tools import eq_ as eq
+from .couch_util import setup, teardown, with_couchdb
+from .util import with_ioloop
+
+import trombi
+from trombi.writebehind import WriteBehindQueue
+
+
+@with_ioloop
+def test_write_behind_offline(ioloop):
+    tmp = tempfile.mkdtemp()
+    try:
+        s = trombi.Server('http://127.0.0.1:1', io_loop=ioloop)
+        db = trombi.Database(s, 'offline')
+        queue = WriteBehindQueue(db, tmp, batch_size=2, segment_size=100,
+                                 fsync='always', retry_delay=0.01)
+        doc_id = queue.set({'value': 0})
+        ids = queue.bulk_docs([{'_id': 'doc1', 'value': 1}, {'value': 2}])
+        eq(ids[0], 'doc1')
+        eq(len(set([doc_id] + ids)), 3)
+        eq(queue.depth, 3)
+        assert len([x for x in os.listdir(tmp) if x.endswith('.log')]) > 1
+
+        queue.start()
+        ioloop.add_timeout(ioloop.time() + 0.1, ioloop.stop)
+        ioloop.start()
+        eq(queue.depth, 3)
+        eq(queue.drained, 0)
+        assert queue.lag > 0
+        queue.close()
+
+        # A record cut short by a crash is dropped on reopening
+        segments = sorted(x for x in os.listdir(tmp) if x.endswith('.log'))
+        fobj = open(os.path.join(tmp, segments[-1]), 'ab')
+        fobj.write(b'1.000\t{"_id": "doc')
+        fobj.close()
+        queue = WriteBehindQueue(db, tmp)
+        eq(queue.depth, 3)
+        queue.close()
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_write_behind_fsync_policy():
+    try:
+        WriteBehindQueue(None, '/nonexistent', fsync='sometimes')
+    except ValueError:
+        pass
+    else:
+        assert False, 'Expected ValueError'
+
+
+@with_ioloop
+@with_couchdb
+def test_write_behind_drain(baseurl, ioloop):
+    tmp = tempfile.mkdtemp()
+    metrics = []
+    errors = []
+
+    def metric(name, value):
+        metrics.append((name, value))
+        if name == 'writebehind.depth' and value == 0:
+            ioloop.stop()
+
+    def on_error(doc, error):
+        errors.append((doc, error.error_type))
+
+    def create_callback(db):
+        dbs.append(db)
+        ioloop.stop()
+
+    dbs = []
+    try:
+        s = trombi.Server(baseurl, io_loop=ioloop, metrics=metric)
+        s.create('writebehind', callback=create_callback)
+        ioloop.start()
+        db, = dbs
+
+        queue = WriteBehindQueue(db, tmp, batch_size=2, segment_size=100,
+                                 on_error=on_error)
+        queue.bulk_docs([{'_id': 'doc%d' % i, 'value': i} for i in range(5)])
+        queue.start()
+        ioloop.start()
+        eq(queue.drained, 5)
+        eq(queue.lag, 0)
+        assert ('writebehind.lag', 0) in metrics
+
+        # Saved again, so the database reports a conflict
+        queue.set({'_id': 'doc0'})
+        ioloop.start()
+        eq(queue.drained, 5)
+        eq(queue.failed, 1)
+        eq(errors, [(b'{"_id": "doc0"}', 'conflict')])
+        queue.close()
+
+        eq(sorted(x for x in os.listdir(tmp) if x.endswith('.log')),
+           ['00000002.log'])
+
+        def got_doc(doc):
+            eq(doc['value'], 4)
+            ioloop.stop()
+
+        db.get('doc4', got_doc)
+        ioloop.start()
+    finally:
+        shutil.rmtree(tmp)
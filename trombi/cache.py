@@ -0,0 +1,104 @@
+# Copyright (c) 2011 Jyrki Pulliainen <jyrki@dywypi.org>
+# Copyright (c) 2010 Inoi Oy
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Caching of view query results"""
+
+import collections
+import time
+
+
+class CacheEntry(object):
+    def __init__(self, body, etag, expires, stale_until):
+        self.body = body
+        self.etag = etag
+        self.expires = expires
+        self.stale_until = stale_until
+        # True while a background refresh of a stale entry is running
+        self.refreshing = False
+
+    def fresh(self):
+        return time.time() < self.expires
+
+    def stale(self):
+        return time.time() < self.stale_until
+
+
+class ViewCache(object):
+    """
+    Least recently used cache of view response bodies, used by
+    :class:`trombi.Server` when given as its view_cache argument.
+
+    Entries are fresh for ttl seconds. After that, they are revalidated
+    with their ETag, and for stale_ttl more seconds they are returned as
+    they are while being refreshed in the background. The cached
+    bodies take at most max_bytes bytes in total.
+    """
+    def __init__(self, ttl=10, max_bytes=16 * 1024 * 1024, stale_ttl=0):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            # Move to the most recently used end
+            self._entries[key] = entry
+        return entry
+
+    def put(self, key, body, etag=None):
+        self._remove(key)
+        if len(body) > self.max_bytes:
+            return None
+        now = time.time()
+        entry = CacheEntry(body, etag, now + self.ttl,
+                           now + self.ttl + self.stale_ttl)
+        self._entries[key] = entry
+        self.size += len(body)
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+        return entry
+
+    def refresh(self, entry):
+        """Marks entry fresh again after it has been revalidated"""
+        now = time.time()
+        entry.expires = now + self.ttl
+        entry.stale_until = now + self.ttl + self.stale_ttl
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry.body)
+
+    def invalidate(self, db=None):
+        """Removes the entries of db, or all entries"""
+        if db is None:
+            self._entries.clear()
+            self.size = 0
+            return
+        for key in [x for x in self._entries if x[0] == db.baseurl]:
+            self._remove(key)
@@ -23,9 +23,15 @@
 
 """Asynchronous CouchDB client"""
 
+import binascii
+import copy
 import functools
 import logging
+import os
+import random
 import re
+import time
+import zlib
 import collections
 import tornado.ioloop
 
@@ -118,14 +124,90 @@ class TrombiDict(TrombiObject, dict):
 
 
 def _jsonize_params(params):
-    result = dict()
-    for key, value in params.items():
-        result[key] = json.dumps(value)
+    # Sorted, so that equal queries have equal URLs
+    result = []
+    for key, value in sorted(params.items()):
+        result.append((key, json.dumps(value)))
     return urlencode(result)
 
 
+def _json_decode(body):
+    return json.loads(body.decode('utf-8'))
+
+
+def _try_json_decode(body):
+    # Returns a (valid, data) pair instead of raising, as the result
+    # may need to be pickled back from an executor process
+    try:
+        return True, _json_decode(body)
+    except ValueError:
+        return False, None
+
+
+def _bulk_docs_body(docs, json_encoder=None, all_or_nothing=False):
+    # Documents are serialized one by one, so that already serialized
+    # documents can be passed in as bytes
+    body = b'{"docs":[' + b','.join(
+        _encode_doc(x, json_encoder) for x in docs) + b']'
+    if all_or_nothing is True:
+        body += b',"all_or_nothing":true'
+    return body + b'}'
+
+
+def _encode_doc(doc, json_encoder=None):
+    if isinstance(doc, bytes):
+        # Already serialized
+        return doc
+    if isinstance(doc, Document):
+        doc = doc.raw()
+    return json.dumps(doc, cls=json_encoder).encode('utf-8')
+
+
+# Quoted document ids, cleared when it grows past _QUOTED_IDS_MAX
+_quoted_ids = {}
+_QUOTED_IDS_MAX = 10000
+
+
+def _quote_id(doc_id):
+    try:
+        return _quoted_ids[doc_id]
+    except KeyError:
+        pass
+    if len(_quoted_ids) >= _QUOTED_IDS_MAX:
+        _quoted_ids.clear()
+    quoted = _quoted_ids[doc_id] = urlquote(doc_id, safe='')
+    return quoted
+
+
+def _remove(queue, entry):
+    # Returns False if entry had already left queue
+    try:
+        queue.remove(entry)
+    except ValueError:
+        return False
+    return True
+
+
+def _seq_number(seq):
+    # The position of a change in the feed. CouchDB 1.x sequences are
+    # numbers, 2.x ones strings like "12-g1AAAA..." and BigCouch ones
+    # lists like [12, "g1AAAA..."].
+    if isinstance(seq, list):
+        seq = seq[0]
+    try:
+        return int(seq)
+    except ValueError:
+        return int(seq.split('-', 1)[0])
+
+
 def _error_response(response):
     if response.code == 599:
+        if isinstance(response.error, CircuitOpenError):
+            return TrombiErrorResponse(trombi.errors.CIRCUIT_OPEN,
+                                       str(response.error))
+        if isinstance(response.error, DeadlineExceededError):
+            return TrombiErrorResponse(trombi.errors.DEADLINE_EXCEEDED,
+                                       str(response.error))
         return TrombiErrorResponse(599, 'Unable to connect to CouchDB')
 
     try:
@@ -139,9 +221,197 @@ def _error_response(response):
         return TrombiErrorResponse(response.code, content)
 
 
+class CircuitOpenError(Exception):
+    pass
+
+
+class DeadlineExceededError(Exception):
+    pass
+
+
+class RequestCancelledError(Exception):
+    pass
+
+
+class _CancelledRequestFilter(logging.Filter):
+    # Tornado logs the exception that aborts a cancelled request
+    def filter(self, record):
+        error = record.exc_info and record.exc_info[1]
+        while error is not None:
+            if isinstance(error, RequestCancelledError):
+                return False
+            error = getattr(error, '__context__', None)
+        return True
+
+logging.getLogger('tornado.application').addFilter(_CancelledRequestFilter())
+
+
+class _Response(object):
+    # Stands in for a tornado HTTPResponse, for responses not read
+    # from the network or modified after it
+    def __init__(self, code, body, headers=None, error=None):
+        self.code = code
+        self.body = body
+        if not isinstance(headers, HTTPHeaders):
+            headers = HTTPHeaders(headers or {})
+        self.headers = headers
+        self.error = error
+
+
+class RequestHandle(object):
+    """
+    Returned by the calls that make requests. After cancel(), the
+    requests are not sent if they are still waiting, in-flight ones
+    are aborted when the next chunk of the response arrives, and the
+    callbacks are not called.
+
+    Requests still waiting at deadline, a time.time() value, fail with
+    DEADLINE_EXCEEDED, and the request_timeout of the sent ones ends
+    at the deadline.
+    """
+    def __init__(self, server, deadline=None):
+        self.server = server
+        self.deadline = deadline
+        self.cancelled = False
+        # Handles of the requests made on behalf of this one
+        self._children = None
+
+    def cancel(self):
+        if not self.cancelled:
+            self.server._metric('request.cancelled')
+            self._cancel()
+
+    def _cancel(self):
+        self.cancelled = True
+        if self._children:
+            for child in list(self._children):
+                child._cancel()
+
+    def _child(self):
+        child = RequestHandle(self.server, self.deadline)
+        if self._children is None:
+            self._children = []
+        self._children.append(child)
+        return child
+
+    def _release(self, child):
+        self._children.remove(child)
+
+    def _wrap(self, callback):
+        def _really_callback(response):
+            if not self.cancelled:
+                callback(response)
+        return _really_callback
+
+    def _check(self, callback):
+        # Returns False if the request must not be sent, after
+        # answering it. Cancelled requests are answered too, so that
+        # wrappers like the circuit breaker see them end; _wrap keeps
+        # the answer from the caller.
+        if self.cancelled:
+            callback(_Response(599, None, error=RequestCancelledError()))
+            return False
+        if self.deadline is not None and time.time() >= self.deadline:
+            self._exceeded(callback)
+            return False
+        return True
+
+    def _exceeded(self, callback):
+        self.server._metric('request.deadline_exceeded')
+        error = DeadlineExceededError('Deadline exceeded')
+        callback(_Response(599, None, error=error))
+
+    def _expire(self, remove, callback):
+        # Returns a timeout failing a waiting request at the deadline,
+        # or None. remove takes the request off its queue and returns
+        # False if it had left already.
+        if self.deadline is None:
+            return None
+
+        def _expired():
+            if remove():
+                self._exceeded(callback)
+        return self.server.io_loop.add_timeout(self.deadline, _expired)
+
+    def _prepare(self, fetch_args, callback):
+        # Returns the fetch_args and callback for sending a request.
+        # The body is read with a streaming_callback, as raising an
+        # exception there is the only way to abort a request. The
+        # fetch_args built by Server._send are modified in place.
+        if self.deadline is not None:
+            remaining = self.deadline - time.time()
+            fetch_args['request_timeout'] = min(
+                fetch_args.get('request_timeout', remaining), remaining)
+            if 'connect_timeout' in fetch_args:
+                fetch_args['connect_timeout'] = min(
+                    fetch_args['connect_timeout'], remaining)
+
+        streaming_callback = fetch_args.get('streaming_callback')
+        if streaming_callback is None:
+            chunks = []
+            streaming_callback = chunks.append
+        else:
+            chunks = None
+
+        def _stream(chunk):
+            if self.cancelled:
+                raise RequestCancelledError()
+            streaming_callback(chunk)
+        fetch_args['streaming_callback'] = _stream
+
+        def _really_callback(response):
+            if (response.code == 599 and self.deadline is not None
+                and not isinstance(response.error, RequestCancelledError)
+                and time.time() >= self.deadline - 0.01):
+                self._exceeded(callback)
+                return
+            if chunks is not None and response.code != 599:
+                response = _Response(response.code, b''.join(chunks),
+                                     response.headers, response.error)
+            callback(response)
+        return fetch_args, _really_callback
+
+
+class _GzipDecoder(object):
+    # Decompresses a response, if its headers say it's gzipped, and
+    # keeps count of the bytes and time taken
+    def __init__(self):
+        self.active = False
+        self.compressed = 0
+        self.decompressed = 0
+        self.seconds = 0
+        self._decompressor = None
+
+    def header(self, line):
+        name, _, value = line.partition(':')
+        if name.strip().lower() == 'content-encoding':
+            self.active = value.strip().lower() == 'gzip'
+            if self.active:
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decode(self, data):
+        if not self.active:
+            return data
+        start = time.time()
+        result = self._decompressor.decompress(data)
+        self.seconds += time.time() - start
+        self.compressed += len(data)
+        self.decompressed += len(result)
+        return result
+
+
 class Server(TrombiObject):
     def __init__(self, baseurl, fetch_args=None, io_loop=None,
-                 json_encoder=None, **client_args):
+                 json_encoder=None, executor=None,
+                 executor_threshold=1024 * 1024, executor_bulk_docs=1000,
+                 metrics=None, uuids=None, uuid_batch=100, view_cache=None,
+                 keys_chunk_size=1000, keys_concurrency=4, gzip_threshold=None,
+                 gzip_responses=False, gzip_level=6, session=None,
+                 session_renew=300, max_concurrent=None,
+                 priority_weights=None, background_limit=None,
+                 rate_limit=None, breaker_threshold=None, breaker_reset=30,
+                 breaker_trials=1, replicas=None, hedge_percentile=95,
+                 hedge_budget=0.05, **client_args):
         self.error = False
         self.baseurl = baseurl
         if self.baseurl[-1] == '/':
@@ -150,6 +420,13 @@ class Server(TrombiObject):
             self._fetch_args = dict()
         else:
             self._fetch_args = fetch_args
+        # The default headers as (name, value) pairs and the rest of
+        # fetch_args, so that they need not be merged on every request
+        headers = self._fetch_args.get(
+            'headers', {'Content-Type': 'application/json'})
+        self._base_headers = tuple(HTTPHeaders(headers).get_all())
+        self._base_fetch_args = dict(
+            (k, v) for k, v in self._fetch_args.items() if k != 'headers')
 
         if io_loop is None:
             self.io_loop = tornado.ioloop.IOLoop.instance()
@@ -158,7 +435,67 @@ class Server(TrombiObject):
         # We can assign None to _json_encoder as the json (or
         # simplejson) then defaults to json.JSONEncoder
         self._json_encoder = json_encoder
+        # Responses larger than executor_threshold bytes are decoded
+        # and bulk_docs requests of at least executor_bulk_docs
+        # documents are encoded in the executor, if one is given
+        self._executor = executor
+        self._executor_threshold = executor_threshold
+        self._executor_bulk_docs = executor_bulk_docs
+        # Called with a metric name and value, see _metric
+        self._metrics = metrics
+        # Source of document ids for new documents, None lets
+        # CouchDB choose them
+        if uuids == 'server':
+            self._uuids = UUIDPool(self, uuid_batch)
+        elif uuids == 'sequential':
+            self._uuids = SequentialUUIDs()
+        elif uuids is None:
+            self._uuids = None
+        else:
+            raise ValueError('Unknown uuids: %r' % uuids)
+        # A trombi.cache.ViewCache for view query results, or None
+        self._view_cache = view_cache
+        # View queries with more keys are split into requests of
+        # keys_chunk_size keys, keys_concurrency of them at a time
+        self._keys_chunk_size = keys_chunk_size
+        self._keys_concurrency = keys_concurrency
+        # JSON request bodies of at least gzip_threshold bytes are
+        # compressed, and with gzip_responses compressed responses
+        # are asked for
+        self._gzip_threshold = gzip_threshold
+        self._gzip_responses = gzip_responses
+        self._gzip_level = gzip_level
+        # A CookieSession, if given the username and password
+        if session is not None:
+            username, password = session
+            self._session = CookieSession(self, username, password,
+                                          session_renew)
+        else:
+            self._session = None
         self._client = AsyncHTTPClient(self.io_loop, **client_args)
+        # Requests are queued by priority when max_concurrent is set
+        if max_concurrent is not None:
+            self._scheduler = RequestScheduler(
+                self, max_concurrent, priority_weights, background_limit)
+        else:
+            self._scheduler = None
+        # A RateLimit for all requests, or None
+        self._rate_limit = rate_limit
+        # With breaker_threshold, a CircuitBreaker for each endpoint
+        # fails the requests to it fast while it's failing
+        self._breaker_threshold = breaker_threshold
+        self._breaker_reset = breaker_reset
+        self._breaker_trials = breaker_trials
+        self._breakers = {}
+        # Slow reads are hedged to the replicas, other nodes of the
+        # same cluster
+        if replicas:
+            self._hedger = ReadHedger(self, replicas, hedge_percentile,
+                                      hedge_budget)
+        else:
+            self._hedger = None
+        # Shared changes feeds, keyed by database name
+        self._changes_feeds = {}
 
     def _invalid_db_name(self, name):
         return TrombiErrorResponse(
@@ -166,16 +503,239 @@ class Server(TrombiObject):
             'Invalid database name: %r' % name,
             )
 
-    def _fetch(self, *args, **kwargs):
+    def _metric(self, name, value=1):
+        if self._metrics is not None:
+            self._metrics(name, value)
+
+    def _run_in_executor(self, func, args, callback, error_callback):
+        # Runs func in the executor and calls callback with its result
+        # in the IOLoop. If func raises, error_callback is called with
+        # a TrombiErrorResponse instead.
+        def _finish(future):
+            try:
+                result = future.result()
+            except Exception as e:
+                log.exception('%s failed in the executor', func.__name__)
+                error_callback(TrombiErrorResponse(
+                        trombi.errors.EXECUTOR_ERROR,
+                        '%s: %s' % (e.__class__.__name__, e)))
+                return
+            callback(result)
+
+        def _done(future):
+            # Called in the executor's thread
+            self.io_loop.add_callback(functools.partial(_finish, future))
+
+        self._executor.submit(func, *args).add_done_callback(_done)
+
+    def _decode_response(self, response, callback, wrap):
+        # Calls callback with wrap(data), where data is the decoded
+        # response body, or with an error if the body is not JSON.
+        # Large bodies are decoded in the executor, so that they don't
+        # block the IOLoop.
+        def _decoded(result):
+            valid, data = result
+            if valid:
+                callback(wrap(data))
+            else:
+                callback(TrombiErrorResponse(response.code, response.body))
+
+        body = response.body
+        if self._executor is None or len(body) < self._executor_threshold:
+            _decoded(_try_json_decode(body))
+        else:
+            self._run_in_executor(_try_json_decode, (body,), _decoded,
+                                  callback)
+
+    def _fetch(self, url, callback, rate_limit=None, handle=None, hedge=None,
+               **kwargs):
+        # Returns the RequestHandle of the request. hedge names the
+        # operation of a read that may be hedged.
+        if handle is None:
+            handle = RequestHandle(self)
+        callback = handle._wrap(callback)
+        if hedge is not None and self._hedger is not None:
+            if rate_limit is not None:
+                kwargs['rate_limit'] = rate_limit
+            self._hedger.fetch(hedge, url, callback, handle, kwargs)
+            return handle
+        kwargs['handle'] = handle
+        if self._breaker_threshold is not None:
+            callback = self._guard(url, callback)
+            if callback is None:
+                return handle
+        if rate_limit is not None or self._rate_limit is not None:
+            self._rate_limited(url, callback, rate_limit, kwargs)
+        elif self._session is not None:
+            self._session.fetch(url, callback, kwargs)
+        else:
+            self._send(url, callback, **kwargs)
+        return handle
+
+    def _guard(self, url, callback):
+        # Returns callback wrapped to record the outcome in the
+        # endpoint's circuit breaker, or None if the circuit is open
+        end = url.find('/', url.find('//') + 2)
+        endpoint = url if end == -1 else url[:end]
+        breaker = self._breakers.get(endpoint)
+        if breaker is None:
+            breaker = self._breakers[endpoint] = CircuitBreaker(
+                endpoint, self._breaker_threshold, self._breaker_reset,
+                self._breaker_trials)
+
+        if not breaker.allow():
+            self._metric('circuit_breaker.rejected')
+            error = CircuitOpenError('Circuit open for %s' % endpoint)
+            self.io_loop.add_callback(functools.partial(
+                    callback, _Response(599, None, error=error)))
+            return None
+
+        trial = breaker.state == CircuitBreaker.HALF_OPEN
+
+        def _recorded(response):
+            # Connection errors, timeouts and overloaded proxies
+            success = response.code not in (599, 502, 503, 504)
+            if isinstance(response.error, (DeadlineExceededError,
+                                           RequestCancelledError)):
+                success = None
+            if breaker.record(success, trial):
+                log.warning('Circuit to %s opened after %d failures',
+                            endpoint, breaker.failures)
+                self._metric('circuit_breaker.open')
+            callback(response)
+        return _recorded
+
+    def _rate_limited(self, url, callback, rate_limit, kwargs):
+        # Waits for the database's rate limit and then the server's
+        limits = []
+        if rate_limit is not None:
+            limits.append(('database', rate_limit))
+        if self._rate_limit is not None:
+            limits.append(('server', self._rate_limit))
+        body = kwargs.get('body')
+        size = len(body) if body else 0
+        handle = kwargs.get('handle')
+
+        def _counted(response):
+            if response.body:
+                for name, limit in limits:
+                    limit.consume(len(response.body))
+            callback(response)
+
+        def _acquired(index, waited=None):
+            if index:
+                self._metric('rate_limit.%s.wait' % limits[index - 1][0],
+                             waited)
+            if handle is not None and not handle._check(callback):
+                return
+            if index < len(limits):
+                limits[index][1].acquire(
+                    size, functools.partial(_acquired, index + 1), handle)
+            elif self._session is not None:
+                self._session.fetch(url, _counted, kwargs)
+            else:
+                self._send(url, _counted, **kwargs)
+
+        _acquired(0)
+
+    def _headers(self, *extra):
+        # A new HTTPHeaders with the default headers and the extra
+        # (name, value) pairs. Tornado modifies the headers of a
+        # request, so every request needs its own.
+        headers = HTTPHeaders()
+        for name, value in self._base_headers:
+            headers[name] = value
+        for name, value in extra:
+            headers[name] = value
+        return headers
+
+    def _send(self, url, callback, priority='default', handle=None,
+              **kwargs):
         # This is just a convenince wrapper for _client.fetch
 
         # Set default arguments for a fetch
-        fetch_args = {
-            'headers': HTTPHeaders({'Content-Type': 'application/json'})
-        }
-        fetch_args.update(self._fetch_args)
-        fetch_args.update(kwargs)
-        self._client.fetch(*args, **fetch_args)
+        if 'headers' not in kwargs:
+            kwargs['headers'] = self._headers()
+        if self._base_fetch_args:
+            fetch_args = dict(self._base_fetch_args)
+            fetch_args.update(kwargs)
+        else:
+            fetch_args = kwargs
+
+        if self._gzip_threshold is None and not self._gzip_responses:
+            self._dispatch(url, callback, fetch_args, priority, handle)
+            return
+
+        headers = fetch_args['headers'] = HTTPHeaders(fetch_args['headers'])
+        body = fetch_args.get('body')
+        if (self._gzip_threshold is not None and body
+            and len(body) >= self._gzip_threshold
+            and headers.get('Content-Type') == 'application/json'):
+            fetch_args['body'] = self._gzip(body)
+            headers['Content-Encoding'] = 'gzip'
+
+        if self._gzip_responses:
+            decoder = _GzipDecoder()
+            callback = self._gunzip_response(callback, decoder)
+            headers['Accept-Encoding'] = 'gzip'
+            # The responses are decompressed here, to measure it
+            fetch_args['decompress_response'] = False
+            fetch_args['header_callback'] = decoder.header
+            streaming_callback = fetch_args.get('streaming_callback')
+            if streaming_callback is not None:
+                fetch_args['streaming_callback'] = (
+                    lambda chunk: streaming_callback(decoder.decode(chunk)))
+
+        self._dispatch(url, callback, fetch_args, priority, handle)
+
+    def _dispatch(self, url, callback, fetch_args, priority, handle=None):
+        # Requests without a priority, like longpoll and continuous
+        # changes feeds, may wait for a long time or never finish, so
+        # they don't take a place from the scheduler. Neither do other
+        # streaming requests.
+        if (self._scheduler is None or priority is None
+            or 'streaming_callback' in fetch_args):
+            self._start(url, callback, fetch_args, handle)
+        else:
+            self._scheduler.fetch(url, callback, fetch_args, priority,
+                                  handle)
+
+    def _start(self, url, callback, fetch_args, handle):
+        if handle is not None:
+            if not handle._check(callback):
+                return
+            fetch_args, callback = handle._prepare(fetch_args, callback)
+        self._client.fetch(url, callback, **fetch_args)
+
+    def _gzip(self, body):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        start = time.time()
+        compressor = zlib.compressobj(
+            self._gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compressed = compressor.compress(body) + compressor.flush()
+        self._metric('gzip.request_time', time.time() - start)
+        self._metric('gzip.request_ratio',
+                     len(compressed) / float(len(body)))
+        return compressed
+
+    def _gunzip_response(self, callback, decoder):
+        def _really_callback(response):
+            if not decoder.active:
+                callback(response)
+                return
+            body = response.body
+            if body:
+                body = decoder.decode(body)
+            if decoder.compressed:
+                self._metric('gzip.response_time', decoder.seconds)
+                self._metric('gzip.response_ratio', decoder.compressed /
+                             float(max(decoder.decompressed, 1)))
+            response = _Response(response.code, body, response.headers,
+                                 response.error)
+            del response.headers['Content-Encoding']
+            callback(response)
+        return _really_callback
 
     def create(self, name, callback):
         if not VALID_DB_NAME.match(name):
@@ -194,7 +754,7 @@ class Server(TrombiObject):
             else:
                 callback(_error_response(response))
 
-        self._fetch(
+        return self._fetch(
             '%s/%s' % (self.baseurl, name),
             _create_callback,
             method='PUT',
@@ -220,7 +780,7 @@ class Server(TrombiObject):
             else:
                 callback(_error_response(response))
 
-        self._fetch(
+        return self._fetch(
             '%s/%s' % (self.baseurl, name),
             _really_callback,
             )
@@ -238,7 +798,7 @@ class Server(TrombiObject):
             else:
                 callback(_error_response(response))
 
-        self._fetch(
+        return self._fetch(
             '%s/%s' % (self.baseurl, name),
             _really_callback,
             method='DELETE',
@@ -252,11 +812,571 @@ class Server(TrombiObject):
             else:
                 callback(_error_response(response))
 
-        self._fetch(
+        return self._fetch(
             '%s/%s' % (self.baseurl, '_all_dbs'),
             _really_callback,
             )
 
+    def uuids(self, callback, count=1):
+        def _really_callback(response):
+            if response.code == 200:
+                self._decode_response(
+                    response, callback,
+                    lambda data: TrombiResult(data['uuids']))
+            else:
+                callback(_error_response(response))
+
+        return self._fetch(
+            '%s/_uuids?count=%d' % (self.baseurl, count),
+            _really_callback,
+            )
+
+
+class UUIDPool(object):
+    """
+    Document ids fetched from CouchDB's _uuids in batches. The pool is
+    refilled in the background when it runs low.
+    """
+    # CouchDB's default for the largest count it hands out at once
+    max_count = 1000
+
+    def __init__(self, server, batch=100):
+        self.server = server
+        self._batch = batch
+        self._ids = collections.deque()
+        self._waiting = collections.deque()
+        self._fetching = False
+
+    def get(self, count, callback):
+        self._waiting.append((count, callback))
+        self._serve()
+
+    def _serve(self):
+        while self._waiting and len(self._ids) >= self._waiting[0][0]:
+            count, callback = self._waiting.popleft()
+            callback(TrombiResult(
+                    [self._ids.popleft() for i in range(count)]))
+
+        if self._fetching:
+            return
+        wanted = sum(count for count, callback in self._waiting)
+        if wanted or len(self._ids) < self._batch // 2:
+            self._fetching = True
+            count = min(max(self._batch, wanted - len(self._ids)),
+                        self.max_count)
+            self.server.uuids(self._refilled, count=count)
+
+    def _refilled(self, result):
+        self._fetching = False
+        if result.error:
+            waiting, self._waiting = self._waiting, collections.deque()
+            for count, callback in waiting:
+                callback(result)
+            return
+        self._ids.extend(result.content)
+        self._serve()
+
+
+class SequentialUUIDs(object):
+    """
+    Generates document ids locally like CouchDB's sequential
+    algorithm: a random prefix and a suffix growing by a random
+    amount. Ids created close in time end up close in the B-tree.
+    """
+    def __init__(self):
+        self._new_prefix()
+
+    def _new_prefix(self):
+        self._prefix = binascii.hexlify(os.urandom(13)).decode('ascii')
+        self._suffix = random.randint(1, 0xffe)
+
+    def new_uuid(self):
+        self._suffix += random.randint(1, 0xffe)
+        if self._suffix >= 0xfff000:
+            self._new_prefix()
+        return '%s%06x' % (self._prefix, self._suffix)
+
+    def get(self, count, callback):
+        callback(TrombiResult([self.new_uuid() for i in range(count)]))
+
+
+class TokenBucket(object):
+    """
+    Holds up to capacity tokens, refilled at rate tokens per second.
+    Taking more tokens than there are leaves the bucket in debt, which
+    is paid back before more can be taken.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        if capacity is None:
+            capacity = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.time()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, count):
+        # Seconds until count tokens can be taken. Counts larger than
+        # the capacity only need a full bucket.
+        self._refill()
+        missing = min(count, self.capacity) - self.tokens
+        return max(missing / self.rate, 0)
+
+    def take(self, count):
+        self._refill()
+        self.tokens -= count
+
+
+class RateLimit(object):
+    """
+    Limits requests to requests per second and the bytes of their
+    bodies to bytes per second, allowing bursts of burst seconds worth
+    of them. Requests over the limit wait in the order they were made.
+    The bytes of the responses are counted when they arrive.
+    """
+    def __init__(self, requests=None, bytes=None, burst=1, io_loop=None):
+        if io_loop is None:
+            io_loop = tornado.ioloop.IOLoop.instance()
+        self.io_loop = io_loop
+        self._requests = None
+        self._bytes = None
+        if requests is not None:
+            self._requests = TokenBucket(requests, requests * burst)
+        if bytes is not None:
+            self._bytes = TokenBucket(bytes, bytes * burst)
+        # Requests delayed so far and the seconds they waited in total
+        self.delayed = 0
+        self.waited = 0
+        self._queue = collections.deque()
+        self._timeout = None
+
+    @property
+    def waiting(self):
+        return len(self._queue)
+
+    def acquire(self, size, callback, handle=None):
+        # Calls callback with the seconds waited, once a request with
+        # a body of size bytes may be sent. A request cancelled or
+        # past the deadline of its handle is let go without tokens.
+        timeout = None
+        if handle is not None and handle.deadline is not None:
+            def _expired():
+                if _remove(self._queue, entry):
+                    callback(time.time() - entry[2])
+            timeout = self.io_loop.add_timeout(handle.deadline, _expired)
+        entry = (size, callback, time.time(), handle, timeout)
+        self._queue.append(entry)
+        if self._timeout is None:
+            self._run()
+
+    def consume(self, size):
+        if self._bytes is not None and size:
+            self._bytes.take(size)
+
+    def _delay(self, size):
+        delay = 0
+        if self._requests is not None:
+            delay = self._requests.delay(1)
+        if self._bytes is not None and size:
+            delay = max(delay, self._bytes.delay(size))
+        return delay
+
+    def _run(self):
+        self._timeout = None
+        while self._queue:
+            size, callback, queued, handle, timeout = self._queue[0]
+            cancelled = handle is not None and handle.cancelled
+            if not cancelled:
+                delay = self._delay(size)
+                if delay > 0:
+                    self._timeout = self.io_loop.add_timeout(
+                        time.time() + delay, self._run)
+                    return
+            self._queue.popleft()
+            if timeout is not None:
+                self.io_loop.remove_timeout(timeout)
+            waited = time.time() - queued
+            if not cancelled:
+                if self._requests is not None:
+                    self._requests.take(1)
+                self.consume(size)
+                if waited > 0.001:
+                    self.delayed += 1
+                    self.waited += waited
+            callback(waited)
+
+
+class CircuitBreaker(object):
+    """
+    Tracks the failures of requests to one endpoint. After threshold
+    failures in a row the circuit opens and requests fail at once.
+    After reset seconds it half-opens and lets trials requests
+    through: a success closes the circuit, a failure opens it again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, endpoint, threshold=5, reset=30, trials=1):
+        self.endpoint = endpoint
+        self.threshold = threshold
+        self.reset = reset
+        self.trials = trials
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened = None
+        self._trials = 0
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if time.time() - self._opened < self.reset:
+                return False
+            self.state = self.HALF_OPEN
+        if self._trials >= self.trials:
+            return False
+        self._trials += 1
+        return True
+
+    def record(self, success, trial=False):
+        # Returns True if the failure opened the circuit. success is
+        # None when the outcome says nothing of the endpoint.
+        if trial:
+            self._trials -= 1
+        if success is None:
+            return False
+        if success:
+            self.failures = 0
+            self.state = self.CLOSED
+            return False
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+            opened = self.state != self.OPEN
+            self.state = self.OPEN
+            self._opened = time.time()
+            return opened
+        return False
+
+
+class LatencyTracker(object):
+    """
+    Keeps the latencies of the last window requests of an operation
+    and answers percentiles of them. The sorted latencies are cached
+    and updated after every window // 10 new requests.
+    """
+    def __init__(self, window=1000, min_samples=20):
+        self.min_samples = min_samples
+        self._samples = collections.deque(maxlen=window)
+        self._sorted = None
+        self._refresh = max(window // 10, 1)
+        self._added = 0
+
+    def add(self, seconds):
+        self._samples.append(seconds)
+        self._added += 1
+        if self._added >= self._refresh:
+            self._sorted = None
+
+    def percentile(self, p):
+        # None until min_samples requests are seen
+        if len(self._samples) < self.min_samples:
+            return None
+        if self._sorted is None:
+            self._sorted = sorted(self._samples)
+            self._added = 0
+        index = int(round(p / 100.0 * (len(self._sorted) - 1)))
+        return self._sorted[index]
+
+
+class ReadHedger(object):
+    """
+    Sends a duplicate of a read to a replica if it takes longer than
+    the percentile latency of its operation. The first response wins
+    and the other request is cancelled. Hedges are limited to budget,
+    a fraction of the reads.
+    """
+    def __init__(self, server, replicas, percentile=95, budget=0.05):
+        self.server = server
+        self.replicas = [x.rstrip('/') for x in replicas]
+        self.percentile = percentile
+        self.budget = budget
+        self._trackers = {}
+        self._next_replica = 0
+        # Every read earns budget credits and a hedge takes one
+        self._credits = 0.0
+
+    def tracker(self, operation):
+        tracker = self._trackers.get(operation)
+        if tracker is None:
+            tracker = self._trackers[operation] = LatencyTracker()
+        return tracker
+
+    def fetch(self, operation, url, callback, handle, kwargs):
+        server = self.server
+        tracker = self.tracker(operation)
+        self._credits = min(self._credits + self.budget, 1 + self.budget)
+        delay = tracker.percentile(self.percentile)
+        primary = handle._child()
+        attempts = [primary]
+        state = {'done': False, 'timeout': None}
+        started = time.time()
+
+        def _finish(child, response):
+            # The callbacks of cancelled requests are not called
+            attempts.remove(child)
+            handle._release(child)
+            failed = response.code in (599, 502, 503, 504)
+            if failed and attempts:
+                # The other one may still succeed
+                return
+            state['done'] = True
+            if state['timeout'] is not None:
+                server.io_loop.remove_timeout(state['timeout'])
+            if not failed:
+                # The latency of the read, even if the hedge answered
+                tracker.add(time.time() - started)
+            if child is not primary:
+                server._metric('hedge.won')
+            for other in attempts:
+                other._cancel()
+                handle._release(other)
+            del attempts[:]
+            callback(response)
+
+        def _send(child, url, kwargs):
+            server._fetch(url, functools.partial(_finish, child),
+                          handle=child, **kwargs)
+
+        def _hedge():
+            state['timeout'] = None
+            if state['done'] or handle.cancelled:
+                return
+            if self._credits < 1:
+                server._metric('hedge.budget_exhausted')
+                return
+            self._credits -= 1
+            server._metric('hedge.sent')
+            replica = self.replicas[self._next_replica % len(self.replicas)]
+            self._next_replica += 1
+            hedge = handle._child()
+            attempts.append(hedge)
+            _send(hedge, replica + url[len(server.baseurl):], kwargs)
+
+        # Tornado modifies the headers of a request, so the hedge
+        # needs its own
+        primary_kwargs = kwargs
+        if delay is not None:
+            state['timeout'] = server.io_loop.add_timeout(
+                time.time() + delay, _hedge)
+            if 'headers' in kwargs:
+                primary_kwargs = dict(kwargs)
+                primary_kwargs['headers'] = HTTPHeaders(kwargs['headers'])
+        _send(primary, url, primary_kwargs)
+
+
+class RequestScheduler(object):
+    """
+    Limits the requests of a server to max_concurrent at a time and
+    queues the rest by priority. Interactive and default requests
+    share the capacity in proportion to weights. Background requests
+    are only sent when no other requests are waiting, and at most
+    background_limit of them at a time.
+    """
+    priorities = ('interactive', 'default', 'background')
+
+    def __init__(self, server, max_concurrent, weights=None,
+                 background_limit=None):
+        self.server = server
+        self.max_concurrent = max_concurrent
+        if weights is None:
+            weights = {'interactive': 4, 'default': 1}
+        self.weights = weights
+        if background_limit is None:
+            background_limit = max(max_concurrent // 2, 1)
+        self.background_limit = background_limit
+        self.active = 0
+        self.active_background = 0
+        self._queues = dict((x, collections.deque()) for x in self.priorities)
+        self._credits = dict(weights)
+
+    def fetch(self, url, callback, fetch_args, priority='default',
+              handle=None):
+        if priority not in self._queues:
+            raise ValueError('Unknown priority: %r' % priority)
+        queue = self._queues[priority]
+        timeout = None
+        if handle is not None:
+            if not handle._check(callback):
+                return
+            timeout = handle._expire(lambda: _remove(queue, entry), callback)
+        entry = (url, callback, fetch_args, priority, handle, time.time(),
+                 timeout)
+        queue.append(entry)
+        self._run()
+
+    def _next(self):
+        waiting = [x for x in ('interactive', 'default') if self._queues[x]]
+        if len(waiting) == 2:
+            # Weighted round robin
+            if not any(self._credits[x] > 0 for x in waiting):
+                self._credits = dict(self.weights)
+            priority = [x for x in waiting if self._credits[x] > 0][0]
+            self._credits[priority] -= 1
+            return self._queues[priority].popleft()
+        if waiting:
+            return self._queues[waiting[0]].popleft()
+        if (self._queues['background']
+            and self.active_background < self.background_limit):
+            return self._queues['background'].popleft()
+        return None
+
+    def _run(self):
+        while self.active < self.max_concurrent:
+            request = self._next()
+            if request is None:
+                return
+            url, callback, fetch_args, priority, handle, queued, timeout = (
+                request)
+            if timeout is not None:
+                self.server.io_loop.remove_timeout(timeout)
+            if handle is not None and not handle._check(callback):
+                continue
+            self.active += 1
+            if priority == 'background':
+                self.active_background += 1
+            self.server._metric('scheduler.%s.wait' % priority,
+                                time.time() - queued)
+            self.server._start(
+                url, functools.partial(self._done, callback, priority),
+                fetch_args, handle)
+
+    def _done(self, callback, priority, response):
+        self.active -= 1
+        if priority == 'background':
+            self.active_background -= 1
+        self._run()
+        callback(response)
+
+
+class CookieSession(object):
+    """
+    Authenticates the requests of a server with a CouchDB session
+    cookie instead of sending the password with every request.
+
+    The first request logs in, and requests made meanwhile wait for
+    it. The cookie is renewed every renew seconds, and taken from the
+    responses when CouchDB refreshes it. A request answered with 401
+    logs in again and is sent once more.
+    """
+    def __init__(self, server, username, password, renew=300):
+        self.server = server
+        self.cookie = None
+        self._username = username
+        self._password = password
+        self._renew = renew
+        self._renew_timeout = None
+        self._logging_in = False
+        # Requests waiting for the login
+        self._waiting = collections.deque()
+
+    def fetch(self, url, callback, kwargs, replay=True):
+        if self.cookie is None:
+            timeout = None
+            handle = kwargs.get('handle')
+            if handle is not None:
+                timeout = handle._expire(
+                    lambda: _remove(self._waiting, entry), callback)
+            entry = (url, callback, kwargs, replay, timeout)
+            self._waiting.append(entry)
+            self.login()
+            return
+
+        cookie = self.cookie
+
+        def _really_callback(response):
+            self._update_cookie(response)
+            if response.code == 401 and replay:
+                if self.cookie == cookie:
+                    # Expired or revoked, unless a newer one exists
+                    self.cookie = None
+                self.fetch(url, callback, kwargs, replay=False)
+                return
+            callback(response)
+
+        fetch_args = dict(kwargs)
+        if 'headers' in kwargs:
+            headers = fetch_args['headers'] = HTTPHeaders(kwargs['headers'])
+            headers['Cookie'] = 'AuthSession=%s' % cookie
+        else:
+            fetch_args['headers'] = self.server._headers(
+                ('Cookie', 'AuthSession=%s' % cookie))
+        self.server._send(url, _really_callback, **fetch_args)
+
+    def login(self):
+        if self._logging_in:
+            return
+        self._logging_in = True
+        self.server._metric('session.login')
+        self.server._send(
+            '%s/_session' % self.server.baseurl,
+            self._logged_in,
+            method='POST',
+            body=urlencode({'name': self._username,
+                            'password': self._password}),
+            headers={'Content-Type': 'application/x-www-form-urlencoded'},
+            # Every other request waits for the login
+            priority='interactive',
+            )
+
+    def _logged_in(self, response):
+        self._logging_in = False
+        if response.code == 200 and self._update_cookie(response):
+            waiting, self._waiting = self._waiting, collections.deque()
+            for url, callback, kwargs, replay, timeout in waiting:
+                if timeout is not None:
+                    self.server.io_loop.remove_timeout(timeout)
+                self.fetch(url, callback, kwargs, replay)
+            return
+
+        log.warning('Logging in to %s failed: %s', self.server.baseurl,
+                    _error_response(response))
+        if self.cookie is None:
+            # The waiting requests get the failed login response
+            waiting, self._waiting = self._waiting, collections.deque()
+            for url, callback, kwargs, replay, timeout in waiting:
+                if timeout is not None:
+                    self.server.io_loop.remove_timeout(timeout)
+                callback(response)
+
+    def _update_cookie(self, response):
+        # Takes a new session cookie from the response, if any
+        for header in response.headers.get_list('Set-Cookie'):
+            name, _, value = header.partition('=')
+            if name.strip() == 'AuthSession':
+                cookie = value.split(';', 1)[0]
+                if cookie and cookie != self.cookie:
+                    self.cookie = cookie
+                    self._schedule_renewal()
+                return bool(cookie)
+        return False
+
+    def _schedule_renewal(self):
+        io_loop = self.server.io_loop
+        if self._renew_timeout is not None:
+            io_loop.remove_timeout(self._renew_timeout)
+        self._renew_timeout = io_loop.add_timeout(
+            time.time() + self._renew, self._renew_cookie)
+
+    def _renew_cookie(self):
+        self._renew_timeout = None
+        self.login()
+
 
 class Database(TrombiObject):
     def __init__(self, server, name):
@@ -264,24 +1384,116 @@ class Database(TrombiObject):
         self._json_encoder = self.server._json_encoder
         self.name = name
         self.baseurl = '%s/%s' % (self.server.baseurl, self.name)
+        self._url_prefix = self.baseurl + '/'
+        # Extra arguments for every request, see with_options
+        self._request_options = {}
+
+    def with_options(self, priority=None, rate_limit=None, deadline=None,
+                     timeout=None, handle=None):
+        """
+        Returns a copy of this database that makes its requests with
+        the given options.
+        """
+        db = copy.copy(self)
+        db._request_options = dict(self._request_options)
+        if priority is not None:
+            db._request_options['priority'] = priority
+        if rate_limit is not None:
+            db._request_options['rate_limit'] = rate_limit
+        if timeout is not None:
+            deadline = time.time() + timeout
+        if deadline is not None:
+            if handle is not None:
+                raise TypeError('Give either a handle or a deadline')
+            handle = RequestHandle(self.server, deadline)
+        if handle is not None:
+            db._request_options['handle'] = handle
+        return db
+
+    def _handle(self):
+        # The handle shared by the requests of a call making several
+        handle = self._request_options.get('handle')
+        if handle is None:
+            handle = RequestHandle(self.server)
+        return handle
 
     def _fetch(self, url, *args, **kwargs):
         # Just a convenience wrapper
         if 'baseurl' in kwargs:
             url = '%s/%s' % (kwargs.pop('baseurl'), url)
         else:
-            url = '%s/%s' % (self.baseurl, url)
+            url = self._url_prefix + url
+        if self._request_options:
+            for key, value in self._request_options.items():
+                kwargs.setdefault(key, value)
         return self.server._fetch(url, *args, **kwargs)
 
+    def _cached_fetch(self, url, callback, cache=True, **kwargs):
+        # Fetches a view, answering from the server's view cache when
+        # possible. The cached bodies are decoded on every use, so that
+        # callers can't modify each others results.
+        view_cache = self.server._view_cache
+        if view_cache is None or not cache:
+            return self._fetch(url, callback, **kwargs)
+
+        key = (self.baseurl, url, kwargs.get('body'))
+        entry = view_cache.get(key)
+
+        def _cached_response(entry):
+            return _Response(200, entry.body, {'ETag': entry.etag or ''})
+
+        def _store(response, metric):
+            if response.code == 304 and entry is not None:
+                self.server._metric('view_cache.revalidated')
+                view_cache.refresh(entry)
+                return _cached_response(entry)
+            if metric:
+                self.server._metric('view_cache.miss')
+            if response.code == 200:
+                view_cache.put(key, response.body,
+                               response.headers.get('ETag'))
+            return response
+
+        def _refreshed(response):
+            entry.refreshing = False
+            _store(response, False)
+
+        # Answers from the cache still return a handle, with nothing
+        # left to cancel
+        handle = kwargs.get('handle') or self._handle()
+
+        if entry is not None and entry.fresh():
+            self.server._metric('view_cache.hit')
+            callback(_cached_response(entry))
+            return handle
+
+        if 'headers' in kwargs:
+            headers = HTTPHeaders(kwargs.pop('headers'))
+        else:
+            headers = self.server._headers()
+        if entry is not None and entry.etag:
+            headers['If-None-Match'] = entry.etag
+
+        if entry is not None and entry.stale():
+            self.server._metric('view_cache.stale')
+            callback(_cached_response(entry))
+            if not entry.refreshing:
+                entry.refreshing = True
+                self._fetch(url, _refreshed, headers=headers, **kwargs)
+            return handle
+
+        return self._fetch(
+            url, lambda response: callback(_store(response, True)),
+            headers=headers, **kwargs)
+
     def info(self, callback):
         def _really_callback(response):
             if response.code == 200:
-                body = response.body.decode('utf-8')
-                callback(TrombiDict(json.loads(body)))
+                self.server._decode_response(response, callback, TrombiDict)
             else:
                 callback(_error_response(response))
 
-        self._fetch('', _really_callback)
+        return self._fetch('', _really_callback)
 
     def set(self, *args, **kwargs):
         if len(args) == 2:
@@ -318,7 +1530,7 @@ class Database(TrombiObject):
             doc_id = doc.id
 
         if doc_id is not None:
-            url = urlquote(doc_id, safe='')
+            url = _quote_id(doc_id)
             method = 'PUT'
         else:
             url = ''
@@ -351,42 +1563,124 @@ class Database(TrombiObject):
             else:
                 callback(_error_response(response))
 
-        self._fetch(
-            url,
-            _really_callback,
-            method=method,
-            body=json.dumps(doc.raw(), cls=self._json_encoder),
-        )
+        handle = self._handle()
+
+        def _send(url, method):
+            self._fetch(
+                url,
+                _really_callback,
+                method=method,
+                body=json.dumps(doc.raw(), cls=self._json_encoder),
+                handle=handle,
+            )
+
+        def _got_uuid(result):
+            if result.error:
+                callback(result)
+                return
+            # The id is stored in the document, so saving the same
+            # document again can not create a duplicate
+            doc.id = result.content[0]
+            _send(_quote_id(doc.id), 'PUT')
+
+        if (doc_id is None and doc.id is None and
+            self.server._uuids is not None):
+            self.server._uuids.get(1, _got_uuid)
+        else:
+            _send(url, method)
+        return handle
 
-    def get(self, doc_id, callback, attachments=False):
+    def get(self, doc_id, callback, attachments=False, raw=False):
         def _really_callback(response):
-            if response.code == 200:
-                data = json.loads(response.body.decode('utf-8'))
-                doc = Document(self, data)
-                callback(doc)
+            if response.code == 200 and raw:
+                callback(TrombiResult(response.body))
+            elif response.code == 200:
+                self.server._decode_response(
+                    response, callback, lambda data: Document(self, data))
             elif response.code == 404:
                 # Document doesn't exist
                 callback(None)
             else:
                 callback(_error_response(response))
 
-        doc_id = urlquote(doc_id, safe='')
+        doc_id = _quote_id(doc_id)
 
         kwargs = {}
 
         if attachments is True:
             doc_id += '?attachments=true'
-            kwargs['headers'] = HTTPHeaders(
-                {'Content-Type': 'application/json',
-                 'Accept': 'application/json',
-             })
+            kwargs['headers'] = self.server._headers(
+                ('Accept', 'application/json'))
 
-        self._fetch(
+        return self._fetch(
             doc_id,
             _really_callback,
+            hedge='get',
             **kwargs
             )
 
+    def update(self, doc, mutator, callback, max_retries=10, backoff=0.05,
+               max_backoff=1):
+        if isinstance(doc, Document):
+            doc_id = doc.id
+            current = doc
+        else:
+            doc_id = doc
+            current = None
+        retries = [0]
+        # All the requests share one handle
+        handle = self._handle()
+        db = self.with_options(handle=handle)
+
+        def _fetch_doc():
+            db.get(doc_id, _apply)
+
+        def _apply(doc):
+            if doc is not None and doc.error:
+                _done(doc)
+                return
+
+            data = mutator(doc)
+            if data is None:
+                # Nothing to change
+                _done(doc)
+                return
+
+            if isinstance(data, Document):
+                new_doc = data
+            else:
+                new_doc = Document(self, data)
+            if doc is not None:
+                new_doc.rev = doc.rev
+                if not new_doc.attachments:
+                    new_doc.attachments = doc.attachments
+            db.set(doc_id, new_doc, _saved)
+
+        def _saved(result):
+            if (result.error and result.errno == trombi.errors.CONFLICT and
+                retries[0] < max_retries):
+                # Somebody else got there first. Back off exponentially
+                # with jitter, so that the competing writers spread out.
+                retries[0] += 1
+                self.server._metric('update.conflict')
+                delay = min(max_backoff, backoff * 2 ** (retries[0] - 1))
+                self.server.io_loop.add_timeout(
+                    time.time() + delay * random.uniform(0.5, 1),
+                    _fetch_doc)
+                return
+            _done(result)
+
+        def _done(result):
+            self.server._metric('update.retries', retries[0])
+            callback(result)
+
+        if current is not None:
+            # Try with the given document first, saving a GET
+            _apply(current)
+        else:
+            _fetch_doc()
+        return handle
+
     def get_attachment(self, doc_id, attachment_name, callback):
         def _really_callback(response):
             if response.code == 200:
@@ -397,21 +1691,22 @@ class Database(TrombiObject):
             else:
                 callback(_error_response(response))
 
-        doc_id = urlquote(doc_id, safe='')
+        doc_id = _quote_id(doc_id)
         attachment_name = urlquote(attachment_name, safe='')
 
-        self._fetch(
+        return self._fetch(
             '%s/%s' % (doc_id, attachment_name),
             _really_callback,
             )
 
-    def view(self, design_doc, viewname, callback, **kwargs):
+    def view(self, design_doc, viewname, callback, raw=False, cache=True,
+             **kwargs):
         def _really_callback(response):
-            if response.code == 200:
-                body = response.body.decode('utf-8')
-                callback(
-                    ViewResult(json.loads(body), db=self)
-                    )
+            if response.code == 200 and raw:
+                callback(TrombiResult(response.body))
+            elif response.code == 200:
+                self.server._decode_response(
+                    response, callback, lambda data: ViewResult(data, db=self))
             else:
                 callback(_error_response(response))
 
@@ -425,18 +1720,92 @@ class Database(TrombiObject):
         # query parameter.
         keys = kwargs.pop('keys', None)
 
+        chunk_size = self.server._keys_chunk_size
+        if (keys is not None and not raw and chunk_size
+            and len(keys) > chunk_size):
+            return self._chunked_view(design_doc, viewname, callback, keys,
+                                      cache, **kwargs)
+
+        # Latencies are tracked for each view
+        operation = url
         if kwargs:
             url = '%s?%s' % (url, _jsonize_params(kwargs))
 
         if keys is not None:
-            self._fetch(url, _really_callback,
-                        method='POST',
-                        body=json.dumps({'keys': keys})
-                        )
+            return self._cached_fetch(url, _really_callback, cache,
+                                      method='POST',
+                                      body=json.dumps({'keys': keys}),
+                                      hedge=operation,
+                                      )
         else:
-            self._fetch(url, _really_callback)
-
-    def list(self, design_doc, listname, viewname, callback, **kwargs):
+            return self._cached_fetch(url, _really_callback, cache,
+                                      hedge=operation)
+
+    def _chunked_view(self, design_doc, viewname, callback, keys, cache,
+                      **kwargs):
+        # Queries the keys in chunks, at most keys_concurrency at a
+        # time, and puts the rows back together in the order of keys
+        chunk_size = self.server._keys_chunk_size
+        chunks = collections.deque(
+            (i, keys[start:start + chunk_size])
+            for i, start in enumerate(range(0, len(keys), chunk_size)))
+        results = [None] * len(chunks)
+        state = {'active': 0, 'error': None}
+        handle = self._handle()
+        db = self.with_options(handle=handle)
+
+        skip = kwargs.pop('skip', 0)
+        limit = kwargs.get('limit')
+        if limit is not None:
+            # Any single chunk may hold all the rows asked for
+            kwargs['limit'] = skip + limit
+
+        def _finish():
+            rows = []
+            for result in results:
+                rows.extend(result._rows)
+            if results[0]._reduced:
+                total_rows = len(rows)
+            else:
+                total_rows = max(x.total_rows for x in results)
+            rows = rows[skip:]
+            if limit is not None:
+                rows = rows[:limit]
+            callback(ViewResult({
+                        'total_rows': total_rows,
+                        'offset': results[0].offset,
+                        'rows': rows,
+                        }, db=self))
+
+        def _chunk_callback(i, result):
+            state['active'] -= 1
+            if state['error'] is not None:
+                return
+            if result.error:
+                state['error'] = result
+                callback(result)
+                return
+            results[i] = result
+            if chunks:
+                _next()
+            elif not state['active']:
+                _finish()
+
+        def _next():
+            while chunks and state['active'] < self.server._keys_concurrency:
+                i, chunk = chunks.popleft()
+                state['active'] += 1
+                db.view(design_doc, viewname,
+                        functools.partial(_chunk_callback, i),
+                        cache=cache, keys=chunk, **kwargs)
+
+        _next()
+        return handle
+
+    def list(self, design_doc, listname, viewname, callback, raw=False,
+             **kwargs):
+        # The list result is never decoded, raw is accepted for
+        # symmetry with view
         def _really_callback(response):
             if response.code == 200:
                 callback(TrombiResult(response.body))
@@ -447,16 +1816,41 @@ class Database(TrombiObject):
         if kwargs:
             url = '%s?%s' % (url, _jsonize_params(kwargs))
 
-        self._fetch(url, _really_callback)
+        return self._fetch(url, _really_callback)
+
+    def update_handler(self, design_doc, handler, callback, doc_id=None,
+                       body=None, **params):
+        def _really_callback(response):
+            if response.code in (200, 201):
+                result = TrombiResult(response.body)
+                result.rev = response.headers.get('X-Couch-Update-NewRev')
+                callback(result)
+            else:
+                callback(_error_response(response))
+
+        url = '_design/%s/_update/%s' % (design_doc, handler)
+        if doc_id is not None:
+            url = '%s/%s' % (url, _quote_id(doc_id))
+            method = 'PUT'
+        else:
+            method = 'POST'
+        if params:
+            # Update handlers see the query parameters as plain strings
+            url = '%s?%s' % (url, urlencode(params))
+
+        if body is None:
+            body = ''
+        elif not isinstance(body, (bytes, type(u''))):
+            body = json.dumps(body, cls=self._json_encoder)
+
+        return self._fetch(url, _really_callback, method=method, body=body)
 
     def temporary_view(self, callback, map_fun, reduce_fun=None,
-                       language='javascript', **kwargs):
+                       language='javascript', cache=True, **kwargs):
         def _really_callback(response):
             if response.code == 200:
-                body = response.body.decode('utf-8')
-                callback(
-                    ViewResult(json.loads(body), db=self)
-                    )
+                self.server._decode_response(
+                    response, callback, lambda data: ViewResult(data, db=self))
             else:
                 callback(_error_response(response))
 
@@ -468,9 +1862,10 @@ class Database(TrombiObject):
         if reduce_fun:
             body['reduce'] = reduce_fun
 
-        self._fetch(url, _really_callback, method='POST',
-                    body=json.dumps(body),
-                    headers={'Content-Type': 'application/json'})
+        return self._cached_fetch(
+            url, _really_callback, cache, method='POST',
+            body=json.dumps(body),
+            headers={'Content-Type': 'application/json'})
 
     def delete(self, data, callback):
         def _really_callback(response):
@@ -489,8 +1884,8 @@ class Database(TrombiObject):
         else:
             doc = Document(self, data)
 
-        doc_id = urlquote(doc.id, safe='')
-        self._fetch(
+        doc_id = _quote_id(doc.id)
+        return self._fetch(
             '%s?rev=%s' % (doc_id, doc.rev),
             _really_callback,
             method='DELETE',
@@ -499,34 +1894,80 @@ class Database(TrombiObject):
     def bulk_docs(self, data, callback, all_or_nothing=False):
         def _really_callback(response):
             if response.code == 200 or response.code == 201:
-                try:
-                    content = json.loads(response.body.decode('utf-8'))
-                except ValueError:
-                    callback(TrombiErrorResponse(response.code, response.body))
-                else:
-                    callback(BulkResult(content))
+                self.server._decode_response(response, callback, BulkResult)
             else:
                 callback(_error_response(response))
 
-        docs = []
-        for element in data:
-            if isinstance(element, Document):
-                docs.append(element.raw())
-            else:
-                docs.append(element)
+        handle = self._handle()
 
-        payload = {'docs': docs}
-        if all_or_nothing is True:
-            payload['all_or_nothing'] = True
+        def _send(body):
+            self._fetch(
+                '_bulk_docs',
+                _really_callback,
+                method='POST',
+                body=body,
+                handle=handle,
+                )
 
-        self._fetch(
-            '_bulk_docs',
-            _really_callback,
-            method='POST',
-            body=json.dumps(payload),
+        def _encode():
+            # Documents are converted to plain data here, as an
+            # executor may need to pickle them
+            docs = [x.raw() if isinstance(x, Document) else x for x in data]
+            args = (docs, self._json_encoder, all_or_nothing)
+            if (self.server._executor is not None and
+                len(docs) >= self.server._executor_bulk_docs):
+                self.server._run_in_executor(_bulk_docs_body, args, _send,
+                                             handle._wrap(callback))
+            else:
+                _send(_bulk_docs_body(*args))
+
+        def _got_uuids(result):
+            if result.error:
+                callback(result)
+                return
+            # The ids are stored in the given documents, so sending
+            # them again can not create duplicates
+            for element, uuid in zip(missing, result.content):
+                if isinstance(element, Document):
+                    element.id = uuid
+                else:
+                    element['_id'] = uuid
+            _encode()
+
+        data = list(data)
+        missing = []
+        if self.server._uuids is not None:
+            for element in data:
+                if isinstance(element, Document):
+                    if element.id is None:
+                        missing.append(element)
+                elif not isinstance(element, bytes) and '_id' not in element:
+                    missing.append(element)
+
+        if missing:
+            self.server._uuids.get(len(missing), _got_uuids)
+        else:
+            _encode()
+        return handle
+
+    def bulk_load(self, docs, callback, chunk_size=500, max_bytes=None,
+                  concurrency=4, on_error=None, progress=None,
+                  all_or_nothing=False, new_edits=True):
+        loader = BulkLoader(
+            self, docs, callback,
+            chunk_size=chunk_size,
+            max_bytes=max_bytes,
+            concurrency=concurrency,
+            on_error=on_error,
+            progress=progress,
+            all_or_nothing=all_or_nothing,
+            new_edits=new_edits,
             )
+        loader.start()
+        return loader
 
-    def changes(self, callback, timeout=None, feed='normal', **kw):
+    def changes(self, callback, timeout=None, feed='normal', raw=False,
+                **kw):
         def _really_callback(response):
             log.debug('Changes feed response: %s', response)
             if response.code != 200:
@@ -536,15 +1977,18 @@ class Database(TrombiObject):
                 # Feed terminated, call callback with None to indicate
                 # this, if the mode is continous
                 callback(None)
+            elif raw:
+                callback(TrombiResult(response.body))
             else:
-                body = response.body.decode('utf-8')
-                callback(TrombiResult(json.loads(body)))
+                self.server._decode_response(response, callback, TrombiResult)
 
         stream_buffer = []
 
         def _stream(text):
-            stream_buffer.append(text.decode('utf-8'))
-            chunks = ''.join(stream_buffer).split('\n')
+            # Lines are split before decoding, so that multibyte
+            # characters split between two chunks survive
+            stream_buffer.append(text)
+            chunks = b''.join(stream_buffer).split(b'\n')
 
             # The last chunk is either an empty string or an
             # incomplete line. Save it for the next round. The [:]
@@ -555,13 +1999,16 @@ class Database(TrombiObject):
                 if not chunk.strip():
                     continue
 
-                try:
-                    obj = json.loads(chunk)
-                except ValueError:
-                    # JSON parsing failed. Apparently we have some
-                    # gibberish on our hands, just discard it.
-                    log.warning('Invalid changes feed line: %s' % chunk)
-                    continue
+                if raw:
+                    result = TrombiResult(chunk)
+                else:
+                    try:
+                        result = TrombiDict(json.loads(chunk.decode('utf-8')))
+                    except ValueError:
+                        # JSON parsing failed. Apparently we have some
+                        # gibberish on our hands, just discard it.
+                        log.warning('Invalid changes feed line: %r' % chunk)
+                        continue
 
                 # "Escape" the streaming_callback context by invoking
                 # the handler as an ioloop callback. This makes it
@@ -572,9 +2019,14 @@ class Database(TrombiObject):
                 #
                 # This also relieves us from handling exceptions in
                 # the handler.
-                cb = functools.partial(callback, TrombiDict(obj))
+                cb = functools.partial(_deliver, result)
                 self.server.io_loop.add_callback(cb)
 
+        def _deliver(result):
+            # Changes read before cancelling are dropped
+            if not handle.cancelled:
+                callback(result)
+
         couchdb_params = kw
         couchdb_params['feed'] = feed
         if timeout is not None:
@@ -584,9 +2036,39 @@ class Database(TrombiObject):
         params = dict()
         if feed == 'continuous':
             params['streaming_callback'] = _stream
+        if feed in ('longpoll', 'continuous'):
+            # Not scheduled, see Server._dispatch
+            params['priority'] = None
 
         log.debug('Fetching changes from %s with params %s', url, params)
-        self._fetch(url, _really_callback, **params)
+        handle = self._fetch(url, _really_callback, **params)
+        return handle
+
+    def follow_changes(self, callback, since=0, predicate=None,
+                       include_docs=False, chunk_size=100, timeout=10,
+                       retry_delay=1, **kw):
+        follower = ChangesFollower(
+            self, callback,
+            since=since,
+            predicate=predicate,
+            include_docs=include_docs,
+            chunk_size=chunk_size,
+            timeout=timeout,
+            retry_delay=retry_delay,
+            **kw)
+        follower.start()
+        return follower
+
+    def changes_feed(self, replay_size=1000, retry_delay=1, heartbeat=10,
+                     **kw):
+        # All Database objects of the same database share the feed
+        feed = self.server._changes_feeds.get(self.name)
+        if feed is None:
+            feed = ChangesFeed(self, replay_size=replay_size,
+                               retry_delay=retry_delay, heartbeat=heartbeat,
+                               **kw)
+            self.server._changes_feeds[self.name] = feed
+        return feed
 
 
 class Document(collections.MutableMapping, TrombiObject):
@@ -651,8 +2133,8 @@ class Document(collections.MutableMapping, TrombiObject):
             doc.rev = content['rev']
             callback(doc)
 
-        self.db._fetch(
-            '%s' % urlquote(self.id, safe=''),
+        return self.db._fetch(
+            '%s' % _quote_id(self.id),
             _copy_done,
             allow_nonstandard_methods=True,
             method='COPY',
@@ -676,9 +2158,9 @@ class Document(collections.MutableMapping, TrombiObject):
 
         headers = {'Content-Type': type, 'Expect': ''}
 
-        self.db._fetch(
+        return self.db._fetch(
             '%s/%s?rev=%s' % (
-                urlquote(self.id, safe=''),
+                _quote_id(self.id),
                 urlquote(name, safe=''),
                 self.rev),
             _really_callback,
@@ -699,10 +2181,11 @@ class Document(collections.MutableMapping, TrombiObject):
             not self.attachments[name].get('stub', False)):
             data = self.attachments[name]['data'].encode('utf-8')
             callback(b64decode(data))
+            return self.db._handle()
         else:
-            self.db._fetch(
+            return self.db._fetch(
                 '%s/%s' % (
-                    urlquote(self.id, safe=''),
+                    _quote_id(self.id),
                     urlquote(name, safe='')
                     ),
                 _really_callback,
@@ -715,7 +2198,7 @@ class Document(collections.MutableMapping, TrombiObject):
                 return
             callback(self)
 
-        self.db._fetch(
+        return self.db._fetch(
             '%s/%s?rev=%s' % (self.id, name, self.rev),
             _really_callback,
             method='DELETE',
@@ -769,12 +2252,16 @@ class ViewResult(TrombiObject, collections.Sequence):
     def __init__(self, result, db=None):
         self.db = db
         self.total_rows = result.get('total_rows', len(result['rows']))
+        # Reduced views have no total_rows of their own
+        self._reduced = 'total_rows' not in result
         self._rows = result['rows']
         self.offset = result.get('offset', 0)
 
     def _format_row(self, row):
-        if 'doc' in row and row['doc']:
-            row['doc'] = Document(self.db, row['doc'])
+        # The row is formatted in place, so it may already have been
+        doc = row.get('doc')
+        if doc and not isinstance(doc, Document):
+            row['doc'] = Document(self.db, doc)
         return row
 
     def __len__(self):
@@ -876,4 +2363,505 @@ class Paginator(TrombiObject):
         self._db.view(design_doc, viewname, _really_callback, **kwargs)
 
 
+class BulkLoader(TrombiObject):
+    """
+    Loads documents from an iterable to the database in chunks.
+
+    Documents are consumed lazily and serialized one by one, so at
+    most concurrency chunks are held in memory at a time. A chunk is
+    closed when it has chunk_size documents or when its serialized
+    size reaches max_bytes. Documents given as bytes are taken to be
+    serialized already and are sent as they are.
+    """
+    def __init__(self, db, docs, callback, chunk_size=500, max_bytes=None,
+                 concurrency=4, on_error=None, progress=None,
+                 all_or_nothing=False, new_edits=True):
+        self.db = db
+        self.loaded = 0
+        self.failed = 0
+        self.committed = 0
+        self.running = False
+        self._docs = iter(docs)
+        self._callback = callback
+        self._chunk_size = chunk_size
+        self._max_bytes = max_bytes
+        self._concurrency = concurrency
+        self._on_error = on_error
+        self._progress = progress
+        self._exhausted = False
+        # Serialized document that did not fit to the previous chunk
+        self._carry = None
+        self._in_flight = 0
+        self._chunks_sent = 0
+        self._chunks_committed = 0
+        # Sizes of the chunks finished out of order, by chunk number
+        self._finished = {}
+
+        options = []
+        if all_or_nothing is True:
+            options.append(b'"all_or_nothing":true')
+        if new_edits is False:
+            options.append(b'"new_edits":false')
+        self._new_edits = new_edits
+        self._body_tail = b''.join(b',' + x for x in options) + b'}'
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self._fill()
+
+    def _next_chunk(self):
+        docs = []
+        encoded = []
+        size = 0
+        if self._carry is not None:
+            doc, data = self._carry
+            self._carry = None
+            docs.append(doc)
+            encoded.append(data)
+            size += len(data)
+
+        while len(docs) < self._chunk_size:
+            try:
+                doc = next(self._docs)
+            except StopIteration:
+                self._exhausted = True
+                break
+            data = _encode_doc(doc, self.db._json_encoder)
+            if (docs and self._max_bytes is not None and
+                size + len(data) > self._max_bytes):
+                self._carry = (doc, data)
+                break
+            docs.append(doc)
+            encoded.append(data)
+            size += len(data) + 1
+        return docs, encoded
+
+    def _fill(self):
+        while (self._in_flight < self._concurrency and
+               not (self._exhausted and self._carry is None)):
+            docs, encoded = self._next_chunk()
+            if not docs:
+                break
+            self._send(self._chunks_sent, docs, encoded)
+            self._chunks_sent += 1
+
+        if self._in_flight == 0:
+            self.running = False
+            self._callback(self)
+
+    def _send(self, number, docs, encoded):
+        def _really_callback(response):
+            if response.code == 200 or response.code == 201:
+                self.db.server._decode_response(
+                    response, _decoded, BulkResult)
+            else:
+                _decoded(_error_response(response))
+
+        def _decoded(result):
+            self._in_flight -= 1
+            if result.error:
+                self._chunk_failed(docs, result)
+            else:
+                self._chunk_done(docs, result)
+            self._commit(number, len(docs))
+            self._fill()
+
+        body = b'{"docs":[' + b','.join(encoded) + b']' + self._body_tail
+        self._in_flight += 1
+        self.db._fetch(
+            '_bulk_docs',
+            _really_callback,
+            method='POST',
+            body=body,
+            )
+
+    def _chunk_done(self, docs, result):
+        if self._new_edits is False:
+            # Only the failures are reported when new_edits is false
+            if not result:
+                self.loaded += len(docs)
+                return
+            # Serialized documents are decoded to find their id, so
+            # this is only done until all the failures are found
+            errors = dict((x.raw.get('id'), x) for x in result)
+            results = []
+            for doc in docs:
+                if errors:
+                    results.append(errors.pop(self._doc_id(doc), None))
+                else:
+                    results.append(None)
+        else:
+            results = result
+
+        for doc, item in zip(docs, results):
+            if item is not None and item.error:
+                self.failed += 1
+                if self._on_error is not None:
+                    self._on_error(doc, item)
+            else:
+                self.loaded += 1
+
+    def _chunk_failed(self, docs, error):
+        self.failed += len(docs)
+        if self._on_error is not None:
+            for doc in docs:
+                self._on_error(doc, error)
+
+    def _doc_id(self, doc):
+        if isinstance(doc, bytes):
+            doc = json.loads(doc.decode('utf-8'))
+        elif isinstance(doc, Document):
+            return doc.id
+        return doc.get('_id')
+
+    def _commit(self, number, size):
+        self._finished[number] = size
+        committed = self.committed
+        while self._chunks_committed in self._finished:
+            self.committed += self._finished.pop(self._chunks_committed)
+            self._chunks_committed += 1
+        if self._progress is not None and self.committed != committed:
+            self._progress(self.committed)
+
+
+class UpdateCoalescer(TrombiObject):
+    """
+    Merges increments of the same document made within window seconds
+    into one call of an update handler. The handler receives the sum
+    of the increments in the query parameter named param.
+    """
+    def __init__(self, db, design_doc, handler, window=0.1, param='by'):
+        self.db = db
+        self._design_doc = design_doc
+        self._handler = handler
+        self._window = window
+        self._param = param
+        # Pending increments, doc_id: [amount, callbacks]
+        self._pending = {}
+
+    def increment(self, doc_id, callback=None, amount=1):
+        pending = self._pending.get(doc_id)
+        if pending is None:
+            pending = self._pending[doc_id] = [0, []]
+            self.db.server.io_loop.add_timeout(
+                time.time() + self._window,
+                functools.partial(self._flush, doc_id))
+        pending[0] += amount
+        if callback is not None:
+            pending[1].append(callback)
+
+    def flush(self):
+        for doc_id in list(self._pending):
+            self._flush(doc_id)
+
+    def _flush(self, doc_id):
+        if doc_id not in self._pending:
+            # Already flushed by flush()
+            return
+        amount, callbacks = self._pending.pop(doc_id)
+
+        def _really_callback(result):
+            for callback in callbacks:
+                callback(result)
+
+        self.db.server._metric('update_handler.coalesced', len(callbacks))
+        params = {self._param: amount}
+        self.db.update_handler(self._design_doc, self._handler,
+                               _really_callback, doc_id=doc_id, **params)
+
+
+class ChangesFollower(TrombiObject):
+    """
+    Follows the longpoll changes feed of a database, starting a new
+    poll from the last_seq of the previous one until stopped.
+
+    Changes can be filtered client side with predicate. If
+    include_docs is set, the documents of the accepted changes are
+    fetched with POSTs to _all_docs, chunk_size documents at a time,
+    instead of asking CouchDB to include documents for every change.
+
+    The poll timeout must stay below the request_timeout of the
+    server, 20 seconds by default. Polls failing with connection
+    errors or 5xx responses are retried after retry_delay seconds.
+    """
+    def __init__(self, db, callback, since=0, predicate=None,
+                 include_docs=False, chunk_size=100, timeout=10,
+                 retry_delay=1, **kw):
+        self.db = db
+        self.since = since
+        self.running = False
+        self._callback = callback
+        self._predicate = predicate
+        self._include_docs = include_docs
+        self._chunk_size = chunk_size
+        self._timeout = timeout
+        self._retry_delay = retry_delay
+        self._params = kw
+        self._handle = None
+        self._retry_timeout = None
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self._poll()
+
+    def stop(self):
+        self.running = False
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if self._retry_timeout is not None:
+            self.db.server.io_loop.remove_timeout(self._retry_timeout)
+            self._retry_timeout = None
+
+    def _poll(self):
+        self._retry_timeout = None
+        self._handle = self.db.changes(
+            self._got_changes,
+            feed='longpoll',
+            timeout=self._timeout,
+            since=self.since,
+            **self._params)
+
+    def _got_changes(self, result):
+        if not self.running:
+            return
+        if result.error and (result.errno >= 500 or
+                             result.errno == trombi.errors.CIRCUIT_OPEN):
+            log.warning('Polling the changes of %s failed, retrying in %s '
+                        'seconds: %s', self.db.name, self._retry_delay,
+                        result.msg)
+            self._retry_timeout = self.db.server.io_loop.add_timeout(
+                time.time() + self._retry_delay, self._poll)
+            return
+        if result.error:
+            self.running = False
+            self._callback(result)
+            return
+
+        rows = result.content['results']
+        last_seq = result.content['last_seq']
+        if self._predicate is not None:
+            rows = [row for row in rows if self._predicate(row)]
+
+        if self._include_docs and rows:
+            self._fetch_docs(rows, last_seq)
+        else:
+            self._deliver(rows, last_seq)
+
+    def _fetch_docs(self, rows, last_seq):
+        ids = []
+        seen = set()
+        for row in rows:
+            if row['id'] not in seen:
+                seen.add(row['id'])
+                ids.append(row['id'])
+        chunks = [ids[i:i + self._chunk_size]
+                  for i in range(0, len(ids), self._chunk_size)]
+        docs = {}
+        pending = [len(chunks)]
+
+        def _chunk_callback(result):
+            if not self.running:
+                return
+            if result.error:
+                self.running = False
+                self._callback(result)
+                return
+            for row in result:
+                docs[row['key']] = row.get('doc')
+            pending[0] -= 1
+            if pending[0] == 0:
+                for row in rows:
+                    row['doc'] = docs.get(row['id'])
+                self._deliver(rows, last_seq)
+
+        for chunk in chunks:
+            self.db.view(None, '_all_docs', _chunk_callback, cache=False,
+                         keys=chunk, include_docs=True)
+
+    def _deliver(self, rows, last_seq):
+        for row in rows:
+            if not self.running:
+                return
+            self._callback(TrombiDict(row))
+        self.since = last_seq
+        if self.running:
+            self._poll()
+
+
+class ChangesFeed(TrombiObject):
+    """
+    Multiplexes one continuous changes feed of a database to any
+    number of subscribers in the same process.
+
+    Every change is decoded once and handed to all subscribers. The
+    last replay_size changes are kept in a ring buffer, so that new
+    subscribers can catch up from a recent sequence number without
+    an additional request.
+    """
+    def __init__(self, db, replay_size=1000, retry_delay=1, heartbeat=10,
+                 **kw):
+        self.db = db
+        self.since = None
+        self.running = False
+        self._replay = collections.deque(maxlen=replay_size)
+        self._subscribers = []
+        self._retry_delay = retry_delay
+        self._heartbeat = heartbeat
+        self._params = kw
+        self._handle = None
+        self._retry_timeout = None
+
+    def subscribe(self, callback, since=None, predicate=None):
+        subscription = ChangesSubscription(self, callback, predicate)
+        self._subscribers.append(subscription)
+
+        if not self.running:
+            # Nobody is listening yet, so the upstream feed can start
+            # right from where this subscriber wants to begin. Changes
+            # of an earlier run don't lead up to it anymore.
+            self.since = since
+            self._replay.clear()
+            self._start()
+        elif since is not None:
+            subscription._catch_up(since)
+        return subscription
+
+    def _unsubscribe(self, subscription):
+        if subscription in self._subscribers:
+            self._subscribers.remove(subscription)
+        if not self._subscribers and self.running:
+            # Nobody is listening, close the upstream feed
+            self.running = False
+            if self._handle is not None:
+                self._handle.cancel()
+                self._handle = None
+            if self._retry_timeout is not None:
+                self.db.server.io_loop.remove_timeout(self._retry_timeout)
+                self._retry_timeout = None
+
+    def _replay_since(self, since):
+        # Returns the buffered changes after since or None, if since
+        # is not known to the buffer.
+        if since == self.since:
+            return []
+        for i, change in enumerate(self._replay):
+            if change['seq'] == since:
+                return list(self._replay)[i + 1:]
+        return None
+
+    def _start(self):
+        self._retry_timeout = None
+        self.running = True
+        if self.since is None:
+            since = 'now'
+        else:
+            since = self.since
+        params = dict(self._params)
+        if self._heartbeat is not None:
+            # Cancelling only aborts the request when something is
+            # received, so an idle feed must still send a line now
+            # and then. CouchDB takes the heartbeat in milliseconds.
+            params['heartbeat'] = int(self._heartbeat * 1000)
+        self._handle = self.db.changes(self._got_change, feed='continuous',
+                                       since=since, **params)
+
+    def _got_change(self, change):
+        if change is None or change.error:
+            if change is not None:
+                log.warning('Changes feed of %s failed: %s',
+                            self.db.name, change.msg)
+            if not self._subscribers:
+                self.running = False
+            elif change is None:
+                self._start()
+            else:
+                self._retry_timeout = self.db.server.io_loop.add_timeout(
+                    time.time() + self._retry_delay,
+                    self._start)
+            return
+
+        if 'seq' not in change:
+            # The final line of the feed only tells the last sequence
+            if 'last_seq' in change:
+                self.since = change['last_seq']
+            return
+
+        self.since = change['seq']
+        self._replay.append(change)
+        for subscription in list(self._subscribers):
+            subscription._push(change)
+
+
+class ChangesSubscription(TrombiObject):
+    """
+    A single subscriber of a :class:`ChangesFeed`. The changes are
+    shared between all subscribers and must not be modified.
+    """
+    def __init__(self, feed, callback, predicate=None):
+        self.feed = feed
+        self.since = None
+        self.active = True
+        self._callback = callback
+        self._predicate = predicate
+        # Live changes are queued here while catching up
+        self._pending = None
+        # The last sequence of the catch-up. Live changes up to it
+        # have been delivered already.
+        self._caught_up_to = None
+
+    def unsubscribe(self):
+        self.active = False
+        self.feed._unsubscribe(self)
+
+    def _push(self, change):
+        if self._pending is not None:
+            self._pending.append(change)
+            return
+        if self._caught_up_to is not None:
+            if _seq_number(change['seq']) <= self._caught_up_to:
+                return
+            self._caught_up_to = None
+        self._deliver(change)
+
+    def _deliver(self, change):
+        if not self.active:
+            return
+        self.since = change['seq']
+        if self._predicate is None or self._predicate(change):
+            self._callback(change)
+
+    def _catch_up(self, since):
+        replay = self.feed._replay_since(since)
+        if replay is not None:
+            for change in replay:
+                self._deliver(change)
+            return
+
+        # Too old for the replay buffer, fetch the missing part with a
+        # normal feed and hold back the live changes until it's done.
+        self._pending = []
+        self.feed.db.changes(self._caught_up, since=since,
+                             **self.feed._params)
+
+    def _caught_up(self, result):
+        pending, self._pending = self._pending, None
+        if result.error:
+            self.unsubscribe()
+            self._callback(result)
+            return
+
+        # The catch-up often reaches further than the live feed, so
+        # live changes are skipped until the feed has passed it
+        for row in result.content['results']:
+            self._deliver(TrombiDict(row))
+        self._caught_up_to = _seq_number(result.content['last_seq'])
+        for change in pending:
+            self._push(change)
+
+
 VALID_DB_NAME = re.compile(r'^[a-z][a-z0-9_$()+-/]*$')
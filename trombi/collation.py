@@ -0,0 +1,190 @@
+# Copyright (c) 2011 Jyrki Pulliainen <jyrki@dywypi.org>
+# Copyright (c) 2010 Inoi Oy
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""CouchDB view collation for sorting and indexing view rows locally"""
+
+import bisect
+import unicodedata
+
+try:
+    _text_type = unicode
+    _string_types = (str, unicode)
+except NameError:
+    # Python 3
+    _text_type = str
+    _string_types = (str,)
+
+# ICU, and thus CouchDB, sorts whitespace and punctuation before digits
+# and digits before letters. Mapping the ASCII symbols below the digits
+# in this order lets plain string comparison do the same.
+_SYMBOLS = u' _-,;:!?.\'"()[]{}@*/\\&#%`^+<=>|~$'
+_PRIMARY = dict((ord(c), i + 1) for i, c in enumerate(_SYMBOLS))
+
+
+def _string_key(value):
+    if not isinstance(value, _text_type):
+        value = value.decode('utf-8')
+    decomposed = unicodedata.normalize('NFD', value)
+    base = u''.join(c for c in decomposed if not unicodedata.combining(c))
+    # Letters compare without accents and case first, then with
+    # accents, and lowercase sorts before uppercase
+    return (base.lower().translate(_PRIMARY),
+            decomposed.lower().translate(_PRIMARY),
+            value.swapcase())
+
+
+def collation_key(value):
+    """
+    Returns a sort key for the JSON value following the CouchDB view
+    collation: null, false, true, numbers, strings, arrays and objects,
+    arrays and objects compared element by element.
+
+    Strings are compared like ICU does for most text, ignoring case and
+    accents before taking them into account; other locale specific
+    rules are not implemented.
+    """
+    if value is None:
+        return (0,)
+    if value is False:
+        return (1,)
+    if value is True:
+        return (2,)
+    if isinstance(value, (int, float)):
+        return (3, value)
+    if isinstance(value, _string_types):
+        return (4,) + _string_key(value)
+    if isinstance(value, (list, tuple)):
+        return (5, tuple(collation_key(x) for x in value))
+    if isinstance(value, dict):
+        return (6, tuple((collation_key(k), collation_key(v))
+                         for k, v in value.items()))
+    raise TypeError('Can not collate %r' % (value,))
+
+
+def compare(a, b):
+    """Returns -1, 0 or 1 as a collates before, with or after b"""
+    a = collation_key(a)
+    b = collation_key(b)
+    return (a > b) - (a < b)
+
+
+def validate_range(startkey, endkey, descending=False):
+    """
+    Raises ValueError if no row can be between startkey and endkey,
+    like CouchDB does for reversed ranges.
+    """
+    order = compare(startkey, endkey)
+    if (order > 0 and not descending) or (order < 0 and descending):
+        raise ValueError(
+            'No rows can match the key range, reverse startkey and '
+            'endkey or set descending')
+
+
+class _After(object):
+    # Greater than any document id, for bounds that include every
+    # row of a key
+    def __lt__(self, other):
+        return False
+
+    def __gt__(self, other):
+        return True
+
+    def __eq__(self, other):
+        return isinstance(other, _After)
+
+_AFTER = _After()
+
+_MISSING = object()
+
+
+class ViewIndex(object):
+    """
+    Keeps view rows sorted in collation order, by key and document id
+    like CouchDB, for answering key range queries locally.
+    """
+    def __init__(self, rows=()):
+        self._keys = []
+        self._rows = []
+        self.update(rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def add(self, row):
+        sort_key = (collation_key(row['key']), row.get('id') or '')
+        i = bisect.bisect_right(self._keys, sort_key)
+        self._keys.insert(i, sort_key)
+        self._rows.insert(i, row)
+
+    def update(self, rows):
+        for row in rows:
+            self.add(row)
+
+    def discard(self, doc_id):
+        """Removes the rows emitted by the document doc_id"""
+        keep = [i for i, row in enumerate(self._rows)
+                if row.get('id') != doc_id]
+        self._keys = [self._keys[i] for i in keep]
+        self._rows = [self._rows[i] for i in keep]
+
+    def _position(self, key, doc_id, before):
+        # Index of the first row of key (and doc_id) if before is true,
+        # otherwise the index after the last one
+        if before:
+            if doc_id is None:
+                return bisect.bisect_left(self._keys, (collation_key(key),))
+            return bisect.bisect_left(self._keys, (collation_key(key), doc_id))
+        if doc_id is None:
+            doc_id = _AFTER
+        return bisect.bisect_right(self._keys, (collation_key(key), doc_id))
+
+    def range(self, startkey=_MISSING, endkey=_MISSING, startkey_docid=None,
+              endkey_docid=None, inclusive_end=True, descending=False,
+              skip=0, limit=None):
+        """
+        Returns the rows a view query with the same arguments would,
+        as a list.
+        """
+        start = 0
+        end = len(self._keys)
+        if descending:
+            if startkey is not _MISSING:
+                end = self._position(startkey, startkey_docid, False)
+            if endkey is not _MISSING:
+                start = self._position(endkey, endkey_docid, inclusive_end)
+        else:
+            if startkey is not _MISSING:
+                start = self._position(startkey, startkey_docid, True)
+            if endkey is not _MISSING:
+                end = self._position(endkey, endkey_docid, not inclusive_end)
+
+        rows = self._rows[start:end]
+        if descending:
+            rows.reverse()
+        rows = rows[skip:]
+        if limit is not None:
+            rows = rows[:limit]
+        return rows
@@ -30,6 +30,9 @@ SERVER_ERROR = 500
 
 # Non-http errors (or overloaded http 500 errors)
 INVALID_DATABASE_NAME = 51
+CIRCUIT_OPEN = 52
+DEADLINE_EXCEEDED = 53
+EXECUTOR_ERROR = 54
 
 errormap = {
     409: CONFLICT,
@@ -0,0 +1,206 @@
+# Copyright (c) 2011 Jyrki Pulliainen <jyrki@dywypi.org>
+# Copyright (c) 2010 Inoi Oy
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Ordered merging of view results from several databases"""
+
+import collections
+import heapq
+
+from trombi.client import TrombiObject, ViewResult
+from trombi.collation import collation_key
+
+
+class _Reversed(object):
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+
+class ViewSource(TrombiObject):
+    """
+    Reads the rows of a view from one database in view order, a page
+    of page_size rows at a time. The next page starts after the last
+    row read, by its key and document id.
+
+    Only the map rows are read. Reduced rows of several databases
+    would need a rereduce to be merged.
+    """
+    def __init__(self, db, design_doc, viewname, page_size=100, **kwargs):
+        if 'keys' in kwargs or 'skip' in kwargs:
+            raise TypeError('ViewSource does not support keys or skip')
+        if (kwargs.get('reduce') or kwargs.get('group')
+            or 'group_level' in kwargs):
+            raise TypeError('ViewSource does not support reduce or group, '
+                            'the reduced rows of several databases can '
+                            'not be merged without a rereduce')
+        if design_doc is not None:
+            # Views with a reduce function reduce by default
+            kwargs['reduce'] = False
+        self.db = db
+        self.design_doc = design_doc
+        self.viewname = viewname
+        self.page_size = page_size
+        self.total_rows = 0
+        self.offset = 0
+        self.exhausted = False
+        self._params = kwargs
+        self._last = None
+
+    def fetch(self, callback):
+        """Calls callback with the next page as a list of rows"""
+        def _got_page(result):
+            if result.error:
+                callback(result)
+                return
+            rows = list(result)
+            if self._last is None:
+                self.total_rows = result.total_rows
+                self.offset = result.offset
+            if len(rows) < self.page_size:
+                self.exhausted = True
+            if rows:
+                self._last = rows[-1]
+            callback(rows)
+
+        params = dict(self._params, limit=self.page_size)
+        if self._last is not None:
+            params['startkey'] = self._last['key']
+            if 'id' in self._last:
+                params['startkey_docid'] = self._last['id']
+            params['skip'] = 1
+        self.db.view(self.design_doc, self.viewname, _got_page, **params)
+
+
+class ViewMerger(TrombiObject):
+    """
+    Merges the rows of several :class:`ViewSource` objects into one
+    :class:`ViewResult` in collation order with a heap, reading more
+    rows from a source only when its last buffered row is merged.
+    """
+    def __init__(self, sources, callback, limit=None, skip=0,
+                 descending=False):
+        self.sources = list(sources)
+        self._callback = callback
+        self._limit = limit
+        self._skip = skip
+        self._descending = descending
+        self._buffers = [collections.deque() for x in self.sources]
+        self._heap = []
+        self._rows = []
+        self._error = None
+
+    def start(self):
+        pending = [len(self.sources)]
+
+        def _got_first_page(i, rows):
+            if not self._page_done(i, rows):
+                return
+            pending[0] -= 1
+            if pending[0] == 0:
+                self._merge()
+
+        if not self.sources:
+            self._finish()
+            return
+        for i, source in enumerate(self.sources):
+            source.fetch(
+                lambda rows, i=i: _got_first_page(i, rows))
+
+    def _sort_key(self, row):
+        key = (collation_key(row['key']), row.get('id') or '')
+        if self._descending:
+            return _Reversed(key)
+        return key
+
+    def _push(self, i):
+        row = self._buffers[i].popleft()
+        heapq.heappush(self._heap, (self._sort_key(row), i, row))
+
+    def _page_done(self, i, rows):
+        if self._error is not None:
+            return False
+        if not isinstance(rows, list):
+            self._error = rows
+            self._callback(rows)
+            return False
+        self._buffers[i].extend(rows)
+        if self._buffers[i]:
+            self._push(i)
+        return True
+
+    def _got_next_page(self, i, rows):
+        if self._page_done(i, rows):
+            self._merge()
+
+    def _merge(self):
+        while self._heap:
+            if self._limit is not None and len(self._rows) >= self._limit:
+                break
+            _, i, row = heapq.heappop(self._heap)
+            if self._skip:
+                self._skip -= 1
+            else:
+                self._rows.append(row)
+
+            if self._buffers[i]:
+                self._push(i)
+            elif not self.sources[i].exhausted:
+                # The next row of this source may come before any row
+                # in the heap, so the merge waits for its next page
+                self.sources[i].fetch(
+                    lambda rows, i=i: self._got_next_page(i, rows))
+                return
+        self._finish()
+
+    def _finish(self):
+        self._callback(ViewResult({
+                    'total_rows': sum(x.total_rows for x in self.sources),
+                    'offset': sum(x.offset for x in self.sources),
+                    'rows': self._rows,
+                    }))
+
+
+def merge_views(databases, design_doc, viewname, callback, limit=None,
+                skip=0, descending=False, page_size=None, **kwargs):
+    """
+    Queries a view from several databases and merges the rows in
+    collation order. The sources read skip + limit rows per request,
+    so the first rows are merged after a single request per database.
+    """
+    if page_size is None:
+        page_size = 1000
+        if limit is not None:
+            page_size = max(min(skip + limit, page_size), 1)
+    if descending:
+        kwargs['descending'] = True
+    sources = [ViewSource(db, design_doc, viewname, page_size, **kwargs)
+               for db in databases]
+    ViewMerger(sources, callback, limit=limit, skip=skip,
+               descending=descending).start()
@@ -0,0 +1,152 @@
+# Copyright (c) 2011 Jyrki Pulliainen <jyrki@dywypi.org>
+# Copyright (c) 2010 Inoi Oy
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Client side sharding of documents across several databases"""
+
+import bisect
+import hashlib
+import json
+
+from trombi.client import (TrombiObject, Document, BulkResult, RequestHandle,
+                           SequentialUUIDs)
+from trombi.merge import merge_views
+
+
+def _hash(value):
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class ShardedDatabase(TrombiObject):
+    """
+    Spreads documents over several databases, possibly on different
+    servers, by consistent hashing of the document id.
+
+    Each database gets replicas points on the hash ring. The points
+    are derived from the database URL, so adding a shard only moves
+    the documents that hash next to its points.
+    """
+    def __init__(self, databases, replicas=64):
+        self.databases = list(databases)
+        ring = []
+        for db in self.databases:
+            for i in range(replicas):
+                ring.append((_hash('%s#%d' % (db.baseurl, i)), db))
+        ring.sort(key=lambda x: x[0])
+        self._ring_keys = [x[0] for x in ring]
+        self._ring_dbs = [x[1] for x in ring]
+        self._uuids = SequentialUUIDs()
+
+    def shard(self, doc_id):
+        i = bisect.bisect(self._ring_keys, _hash(doc_id))
+        return self._ring_dbs[i % len(self._ring_dbs)]
+
+    def _handle(self):
+        # The handle shared by the requests made to all the shards
+        return RequestHandle(self.databases[0].server)
+
+    def _doc_id(self, data):
+        if isinstance(data, Document):
+            return data.id
+        return data.get('_id')
+
+    def get(self, doc_id, callback, **kwargs):
+        return self.shard(doc_id).get(doc_id, callback, **kwargs)
+
+    def set(self, *args, **kwargs):
+        if len(args) == 2:
+            data, callback = args
+            doc_id = self._doc_id(data)
+        elif len(args) == 3:
+            doc_id, data, callback = args
+        else:
+            raise TypeError(
+                'ShardedDatabase.set expected 2 or 3 arguments, got %d' %
+                len(args))
+
+        if doc_id is None:
+            # The id decides the shard, so it has to be known up front
+            doc_id = self._uuids.new_uuid()
+        return self.shard(doc_id).set(doc_id, data, callback, **kwargs)
+
+    def delete(self, data, callback):
+        return self.shard(self._doc_id(data)).delete(data, callback)
+
+    def bulk_docs(self, data, callback, all_or_nothing=False):
+        data = list(data)
+        # Per shard lists of documents and their positions in data
+        batches = {}
+        for i, element in enumerate(data):
+            if isinstance(element, bytes):
+                # Serialized documents are sent as they are, so their
+                # id can't be generated here
+                doc_id = json.loads(element.decode('utf-8')).get('_id')
+                if doc_id is None:
+                    raise TypeError('Serialized documents must have an _id')
+            else:
+                doc_id = self._doc_id(element)
+            if doc_id is None:
+                doc_id = self._uuids.new_uuid()
+                if isinstance(element, Document):
+                    element.id = doc_id
+                else:
+                    element['_id'] = doc_id
+            db = self.shard(doc_id)
+            docs, positions = batches.setdefault(db.baseurl, (db, [], []))[1:]
+            docs.append(element)
+            positions.append(i)
+
+        results = [None] * len(data)
+        errors = []
+        pending = [len(batches)]
+        handle = self._handle()
+
+        def _batch_callback(positions, result):
+            if result.error:
+                errors.append(result)
+            else:
+                for position, item in zip(positions, result):
+                    results[position] = item
+            pending[0] -= 1
+            if pending[0] == 0:
+                if errors:
+                    callback(errors[0])
+                else:
+                    bulk_result = BulkResult([])
+                    bulk_result.content = results
+                    callback(bulk_result)
+
+        if not batches:
+            callback(BulkResult([]))
+        for db, docs, positions in list(batches.values()):
+            db.with_options(handle=handle).bulk_docs(
+                docs,
+                lambda result, positions=positions: _batch_callback(
+                    positions, result),
+                all_or_nothing=all_or_nothing)
+        return handle
+
+    def view(self, design_doc, viewname, callback, **kwargs):
+        handle = self._handle()
+        databases = [db.with_options(handle=handle) for db in self.databases]
+        merge_views(databases, design_doc, viewname, callback, **kwargs)
+        return handle
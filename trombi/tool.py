@@ -0,0 +1,359 @@
+# Copyright (c) 2011 Jyrki Pulliainen <jyrki@dywypi.org>
+# Copyright (c) 2010 Inoi Oy
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Export and import whole databases as newline delimited JSON
+
+Usage::
+
+    python -m trombi export http://localhost:5984/mydb mydb.ndjson.gz
+    python -m trombi import http://localhost:5984/mydb mydb.ndjson.gz
+"""
+
+import gzip
+import mmap
+import optparse
+import os
+import sys
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import trombi
+
+
+def _open(path, mode, compress=None):
+    if compress is None:
+        compress = path.endswith('.gz')
+    if compress:
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def _open_at(path, offset, compress=None):
+    # Opens path for writing after its first offset bytes, dropping
+    # whatever an interrupted export wrote after them
+    if compress is None:
+        compress = path.endswith('.gz')
+    if not compress:
+        fobj = open(path, 'r+b')
+        fobj.seek(offset)
+        fobj.truncate()
+        return fobj
+
+    # A gzip stream can't be cut, so the kept part is copied to a new
+    # file. The old one may end in the middle of a batch, but the
+    # bytes before offset were flushed and can be read.
+    tmp = '%s.tmp' % path
+    source = gzip.open(path, 'rb')
+    try:
+        target = gzip.open(tmp, 'wb')
+        while offset:
+            data = source.read(min(offset, 1024 * 1024))
+            if not data:
+                break
+            target.write(data)
+            offset -= len(data)
+    finally:
+        source.close()
+    os.rename(tmp, path)
+    return target
+
+
+def iter_records(fobj):
+    """
+    Yields the non-empty lines of fobj as bytes, without the line
+    terminator. Regular files are memory mapped instead of read line
+    by line, so the only copy made of a record is the one yielded.
+    """
+    if not isinstance(fobj, gzip.GzipFile) and hasattr(fobj, 'fileno'):
+        try:
+            data = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            # Empty files and pipes can not be mapped
+            data = None
+        if data is not None:
+            try:
+                pos = 0
+                size = len(data)
+                while pos < size:
+                    end = data.find(b'\n', pos)
+                    if end == -1:
+                        end = size
+                    record = data[pos:end].strip()
+                    pos = end + 1
+                    if record:
+                        yield record
+            finally:
+                data.close()
+            return
+
+    for line in fobj:
+        record = line.strip()
+        if record:
+            yield record
+
+
+def read_checkpoint(path):
+    try:
+        fobj = open(path, 'r')
+    except IOError:
+        return None
+    try:
+        return json.load(fobj)
+    finally:
+        fobj.close()
+
+
+def write_checkpoint(path, data):
+    # Write to a temporary file first, so that a crash never leaves a
+    # half written checkpoint behind
+    tmp = '%s.tmp' % path
+    fobj = open(tmp, 'w')
+    try:
+        json.dump(data, fobj)
+        fobj.flush()
+        os.fsync(fobj.fileno())
+    finally:
+        fobj.close()
+    os.rename(tmp, path)
+
+
+class Exporter(object):
+    """
+    Writes all documents of a database to fobj, one JSON document per
+    line, reading _all_docs batch_size documents at a time.
+
+    If checkpoint is given, the id of the last written document and
+    the position of fobj after it are stored there after every batch,
+    and the export continues after it. The file must then be opened
+    at that position, see _open_at.
+    """
+    def __init__(self, db, fobj, callback, batch_size=1000,
+                 attachments=False, checkpoint=None):
+        self.db = db
+        self.exported = 0
+        self.error = None
+        self._fobj = fobj
+        self._callback = callback
+        self._batch_size = batch_size
+        self._attachments = attachments
+        self._checkpoint = checkpoint
+        self._last_id = None
+        if checkpoint is not None:
+            state = read_checkpoint(checkpoint)
+            if state is not None:
+                self._last_id = state['last_id']
+
+    def start(self):
+        self._fetch_batch()
+
+    def _fetch_batch(self):
+        params = {
+            'include_docs': True,
+            'limit': self._batch_size,
+            }
+        if self._attachments:
+            params['attachments'] = True
+        if self._last_id is not None:
+            params['startkey'] = self._last_id
+            params['skip'] = 1
+        self.db.view(None, '_all_docs', self._got_batch, cache=False,
+                     **params)
+
+    def _got_batch(self, result):
+        if result.error:
+            self.error = result
+            self._callback(self)
+            return
+
+        for row in result:
+            doc = row['doc'].raw()
+            if not self._attachments:
+                # The stubs can't be imported without the attachments
+                doc.pop('_attachments', None)
+            line = json.dumps(doc) + '\n'
+            self._fobj.write(line.encode('utf-8'))
+            self._last_id = row['id']
+        self.exported += len(result)
+        self._fobj.flush()
+
+        if self._checkpoint is not None and self._last_id is not None:
+            write_checkpoint(self._checkpoint, {
+                    'last_id': self._last_id,
+                    'offset': self._fobj.tell(),
+                    })
+
+        if len(result) < self._batch_size:
+            self._callback(self)
+        else:
+            self._fetch_batch()
+
+
+class Importer(object):
+    """
+    Loads documents written by :class:`Exporter` from fobj to a
+    database with the bulk API. The revisions are kept as they are,
+    so importing the same document twice is harmless. The documents
+    are not decoded, their JSON is passed to the request body as is.
+
+    If checkpoint is given, the number of documents handled is stored
+    there as the import proceeds and the import continues after it.
+    """
+    def __init__(self, db, fobj, callback, batch_size=1000,
+                 concurrency=4, checkpoint=None, on_error=None):
+        self.db = db
+        self.imported = 0
+        self.failed = 0
+        self.error = None
+        self._fobj = fobj
+        self._callback = callback
+        self._batch_size = batch_size
+        self._concurrency = concurrency
+        self._checkpoint = checkpoint
+        self._on_error = on_error
+        self._skip = 0
+        if checkpoint is not None:
+            state = read_checkpoint(checkpoint)
+            if state is not None:
+                self._skip = state['records']
+
+    def _docs(self):
+        for i, record in enumerate(iter_records(self._fobj)):
+            if i >= self._skip:
+                yield record
+
+    def _progress(self, committed):
+        if self._checkpoint is not None:
+            write_checkpoint(self._checkpoint,
+                             {'records': self._skip + committed})
+
+    def _loaded(self, loader):
+        self.imported = loader.loaded
+        self.failed = loader.failed
+        self._callback(self)
+
+    def start(self):
+        self.db.bulk_load(
+            self._docs(),
+            self._loaded,
+            chunk_size=self._batch_size,
+            concurrency=self._concurrency,
+            on_error=self._on_error,
+            progress=self._progress,
+            new_edits=False,
+            )
+
+
+def _run(db, worker_class, fobj, **kwargs):
+    results = []
+
+    def _done(worker):
+        results.append(worker)
+        db.server.io_loop.stop()
+
+    worker = worker_class(db, fobj, _done, **kwargs)
+    db.server.io_loop.add_callback(worker.start)
+    db.server.io_loop.start()
+    return results[0]
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+        usage='%prog export|import DATABASE_URI FILE [options]')
+    parser.add_option(
+        '-z', '--gzip', action='store_true', dest='compress', default=None,
+        help='gzip the file (default: if FILE ends with .gz)')
+    parser.add_option(
+        '-b', '--batch-size', type='int', default=1000,
+        help='documents per request (default: %default)')
+    parser.add_option(
+        '-c', '--concurrency', type='int', default=4,
+        help='concurrent bulk requests when importing (default: %default)')
+    parser.add_option(
+        '-a', '--attachments', action='store_true', default=False,
+        help='include attachments in the export')
+    parser.add_option(
+        '-r', '--resume', action='store_true', default=False,
+        help='keep a checkpoint next to FILE and resume from it')
+    options, args = parser.parse_args(argv)
+
+    if len(args) != 3 or args[0] not in ('export', 'import'):
+        parser.error('expected export or import, a database URI and a file')
+    command, uri, path = args
+
+    db = trombi.from_uri(uri)
+    checkpoint = None
+    if options.resume:
+        checkpoint = '%s.%s-checkpoint' % (path, command)
+
+    if command == 'export':
+        state = None
+        if checkpoint is not None:
+            state = read_checkpoint(checkpoint)
+        if state is None:
+            fobj = _open(path, 'wb', options.compress)
+        else:
+            fobj = _open_at(path, state['offset'], options.compress)
+        try:
+            worker = _run(db, Exporter, fobj,
+                          batch_size=options.batch_size,
+                          attachments=options.attachments,
+                          checkpoint=checkpoint)
+        finally:
+            fobj.close()
+        if worker.error is None:
+            sys.stderr.write('Exported %d documents\n' % worker.exported)
+    else:
+        def _on_error(doc, error):
+            doc = json.loads(doc.decode('utf-8'))
+            if isinstance(error, trombi.BulkError):
+                reason = error.reason or error.error_type
+            else:
+                reason = error.msg
+            sys.stderr.write('Failed to import %s: %s\n' % (
+                    doc.get('_id'), reason))
+
+        fobj = _open(path, 'rb', options.compress)
+        try:
+            worker = _run(db, Importer, fobj,
+                          batch_size=options.batch_size,
+                          concurrency=options.concurrency,
+                          checkpoint=checkpoint,
+                          on_error=_on_error)
+        finally:
+            fobj.close()
+        sys.stderr.write('Imported %d documents, %d failed\n' % (
+                worker.imported, worker.failed))
+        if worker.failed:
+            return 1
+
+    if worker.error is not None:
+        sys.stderr.write('%s\n' % worker.error)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,148 @@
+# Copyright (c) 2011 Jyrki Pulliainen <jyrki@dywypi.org>
+# Copyright (c) 2010 Inoi Oy
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Keeping view indexes up to date ahead of the queries"""
+
+import collections
+import logging
+import time
+
+from trombi.client import TrombiObject
+
+log = logging.getLogger('trombi')
+
+
+class ViewWarmer(TrombiObject):
+    """
+    Follows the changes of a database and queries the registered views
+    with limit=0 after changes changes, or after idle seconds without
+    new changes, so that CouchDB updates their indexes before somebody
+    needs them. The changes are followed from since, by default from
+    now on.
+
+    All views of a design document share one index, so registering one
+    view per design document is enough.
+    """
+    def __init__(self, db, views=(), changes=100, idle=5, concurrency=2,
+                 since=None):
+        self.db = db
+        self.since = since
+        self.running = False
+        # Statistics
+        self.changes_seen = 0
+        self.warmups = 0
+        self.queries = 0
+        self.failed = 0
+        self.last_duration = None
+        self._views = []
+        # The warm-up queries only use capacity left over by others
+        self._background_db = db.with_options(priority='background')
+        self._changes = changes
+        self._idle = idle
+        self._concurrency = concurrency
+        self._unwarmed = 0
+        self._subscription = None
+        self._timeout = None
+        # Views waiting for their query in the current warm-up
+        self._queue = collections.deque()
+        self._active = 0
+        self._started = None
+        self._again = False
+        for design_doc, viewname in views:
+            self.add_view(design_doc, viewname)
+
+    def add_view(self, design_doc, viewname):
+        if (design_doc, viewname) not in self._views:
+            self._views.append((design_doc, viewname))
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self._subscription = self.db.changes_feed().subscribe(
+            self._got_change, since=self.since)
+
+    def stop(self):
+        self.running = False
+        self._cancel_timeout()
+        if self._subscription is not None:
+            self._subscription.unsubscribe()
+            self._subscription = None
+
+    def _cancel_timeout(self):
+        if self._timeout is not None:
+            self.db.server.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+
+    def _got_change(self, change):
+        if change.error:
+            log.warning('View warmer of %s lost the changes feed: %s',
+                        self.db.name, change.msg)
+            self.stop()
+            return
+        self.since = change['seq']
+        self.changes_seen += 1
+        self._unwarmed += 1
+        self._cancel_timeout()
+        if self._unwarmed >= self._changes:
+            self.warm()
+        else:
+            self._timeout = self.db.server.io_loop.add_timeout(
+                time.time() + self._idle, self.warm)
+
+    def warm(self):
+        """Queries all the registered views now"""
+        self._cancel_timeout()
+        if self._active or self._queue:
+            # Changes made during a warm-up may have missed it
+            self._again = True
+            return
+        self._unwarmed = 0
+        self._started = time.time()
+        self._queue.extend(self._views)
+        self._next()
+
+    def _next(self):
+        while self._queue and self._active < self._concurrency:
+            design_doc, viewname = self._queue.popleft()
+            self._active += 1
+            self.queries += 1
+            self._background_db.view(design_doc, viewname, self._warmed,
+                                     cache=False, limit=0)
+
+    def _warmed(self, result):
+        self._active -= 1
+        if result.error:
+            self.failed += 1
+            log.warning('Warming a view of %s failed: %s',
+                        self.db.name, result.msg)
+        if self._queue:
+            self._next()
+        elif not self._active:
+            self.warmups += 1
+            self.last_duration = time.time() - self._started
+            self.db.server._metric('view_warmer.duration',
+                                   self.last_duration)
+            if self._again and self.running:
+                self._again = False
+                self.warm()
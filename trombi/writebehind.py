@@ -0,0 +1,343 @@
+# Copyright (c) 2011 Jyrki Pulliainen <jyrki@dywypi.org>
+# Copyright (c) 2010 Inoi Oy
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Buffering writes in local files while CouchDB is unreachable"""
+
+import functools
+import logging
+import os
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from trombi.client import Document, SequentialUUIDs, TrombiObject
+from trombi.tool import read_checkpoint, write_checkpoint
+
+log = logging.getLogger('trombi')
+
+# Errors about the documents themselves, a retry would fail again
+_DATA_ERRORS = (400, 413)
+
+
+class WriteBehindQueue(TrombiObject):
+    """
+    Appends documents to segment files in the directory path and
+    saves them to the database with _bulk_docs, batch_size documents
+    at a time. A write is acknowledged once it is in the file, so
+    producers keep going while CouchDB is unreachable, and the batches
+    are retried until it is back.
+
+    fsync is 'always' to sync every write, 'interval' to sync every
+    fsync_interval seconds, or 'never' to leave it to the OS. A new
+    segment is started when the current one reaches segment_size
+    bytes, and drained segments are removed.
+    """
+    def __init__(self, db, path, batch_size=500,
+                 segment_size=64 * 1024 * 1024, fsync='interval',
+                 fsync_interval=1, retry_delay=1, max_retry_delay=30,
+                 on_error=None):
+        if fsync not in ('always', 'interval', 'never'):
+            raise ValueError('Unknown fsync policy: %r' % fsync)
+        self.db = db
+        self.path = path
+        self.running = False
+        # Documents written but not yet saved to the database
+        self.depth = 0
+        self.drained = 0
+        self.failed = 0
+        self._batch_size = batch_size
+        self._segment_size = segment_size
+        self._fsync = fsync
+        self._fsync_interval = fsync_interval
+        self._retry_delay = retry_delay
+        self._max_retry_delay = max_retry_delay
+        self._on_error = on_error
+        self._uuids = SequentialUUIDs()
+        self._delay = retry_delay
+        self._sending = False
+        self._drain_scheduled = False
+        self._retry_timeout = None
+        self._fsync_timeout = None
+        self._dirty = False
+        # Write time of the oldest document not yet saved
+        self._oldest = None
+        self._checkpoint = os.path.join(path, 'checkpoint')
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._open()
+
+    @property
+    def lag(self):
+        # Seconds the oldest unsaved document has waited
+        if not self.depth or self._oldest is None:
+            return 0
+        return time.time() - self._oldest
+
+    def _segment_path(self, number):
+        return os.path.join(self.path, '%08d.log' % number)
+
+    def _open(self):
+        segments = sorted(int(name[:-4]) for name in os.listdir(self.path)
+                          if name.endswith('.log'))
+        state = read_checkpoint(self._checkpoint)
+        if state is None:
+            state = {'segment': segments and segments[0] or 0, 'offset': 0}
+        self._read_segment = state['segment']
+        self._read_offset = state['offset']
+        self._write_segment = max(segments + [self._read_segment])
+
+        path = self._segment_path(self._write_segment)
+        if os.path.exists(path):
+            self._repair(path)
+        for number in segments:
+            if number >= self._read_segment:
+                self.depth += self._count(number)
+        self._file = open(path, 'ab')
+        self._size = os.path.getsize(path)
+        self._find_oldest()
+
+    def _repair(self, path):
+        # Cuts off a record left half written by a crash
+        fobj = open(path, 'rb+')
+        try:
+            fobj.seek(0, os.SEEK_END)
+            end = fobj.tell()
+            pos = end
+            while pos > 0:
+                start = max(pos - 4096, 0)
+                fobj.seek(start)
+                block = fobj.read(pos - start)
+                newline = block.rfind(b'\n')
+                if newline != -1:
+                    pos = start + newline + 1
+                    break
+                pos = start
+            if pos != end:
+                log.warning('Truncating a partial record of %s', path)
+                fobj.truncate(pos)
+        finally:
+            fobj.close()
+
+    def _count(self, number):
+        fobj = open(self._segment_path(number), 'rb')
+        try:
+            if number == self._read_segment:
+                fobj.seek(self._read_offset)
+            count = 0
+            for block in iter(functools.partial(fobj.read, 65536), b''):
+                count += block.count(b'\n')
+            return count
+        finally:
+            fobj.close()
+
+    def set(self, data):
+        """
+        Writes a document to the queue and returns its id. Documents
+        without an id are given one here, so that sending them again
+        can not create duplicates.
+        """
+        doc_id = self._append(data)
+        self._written()
+        return doc_id
+
+    def bulk_docs(self, data):
+        """
+        Writes documents to the queue and returns their ids.
+        """
+        ids = [self._append(x) for x in data]
+        self._written()
+        return ids
+
+    def _append(self, data):
+        if isinstance(data, Document):
+            doc = data.raw()
+        else:
+            doc = dict(data)
+        if doc.get('_id') is None:
+            doc['_id'] = self._uuids.new_uuid()
+
+        now = time.time()
+        record = (('%.3f\t' % now).encode('ascii') +
+                  json.dumps(doc, cls=self.db._json_encoder).encode('utf-8') +
+                  b'\n')
+        if self._size and self._size + len(record) > self._segment_size:
+            self._next_segment()
+        self._file.write(record)
+        self._size += len(record)
+        if not self.depth:
+            self._oldest = now
+        self.depth += 1
+        return doc['_id']
+
+    def _written(self):
+        self._file.flush()
+        if self._fsync == 'always':
+            os.fsync(self._file.fileno())
+        elif self._fsync == 'interval':
+            self._dirty = True
+            if self._fsync_timeout is None:
+                self._fsync_timeout = self.db.server.io_loop.add_timeout(
+                    time.time() + self._fsync_interval, self._sync)
+        if self.running and not self._drain_scheduled:
+            self._drain_scheduled = True
+            self.db.server.io_loop.add_callback(self._drain)
+
+    def _sync(self):
+        self._fsync_timeout = None
+        if self._dirty:
+            self.flush()
+
+    def flush(self):
+        """
+        Syncs the written documents to disk.
+        """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._dirty = False
+
+    def _next_segment(self):
+        self.flush()
+        self._file.close()
+        self._write_segment += 1
+        self._file = open(self._segment_path(self._write_segment), 'ab')
+        self._size = 0
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self._drain()
+
+    def stop(self):
+        """
+        Stops saving documents to the database. A batch being sent is
+        still committed. Documents can be written while stopped.
+        """
+        self.running = False
+        if self._retry_timeout is not None:
+            self.db.server.io_loop.remove_timeout(self._retry_timeout)
+            self._retry_timeout = None
+
+    def close(self):
+        self.stop()
+        if self._fsync_timeout is not None:
+            self.db.server.io_loop.remove_timeout(self._fsync_timeout)
+            self._fsync_timeout = None
+        if self._fsync != 'never':
+            self.flush()
+        self._file.close()
+
+    def _read_batch(self, size):
+        # Returns the next records and the position after them
+        records = []
+        segment, offset = self._read_segment, self._read_offset
+        while True:
+            fobj = open(self._segment_path(segment), 'rb')
+            try:
+                fobj.seek(offset)
+                while len(records) < size:
+                    line = fobj.readline()
+                    if not line.endswith(b'\n'):
+                        break
+                    records.append(line)
+                    offset += len(line)
+            finally:
+                fobj.close()
+            if len(records) < size and segment < self._write_segment:
+                segment += 1
+                offset = 0
+            else:
+                return records, segment, offset
+
+    def _drain(self):
+        self._drain_scheduled = False
+        if (not self.running or self._sending or not self.depth
+            or self._retry_timeout is not None):
+            return
+        records, segment, offset = self._read_batch(self._batch_size)
+        if not records:
+            return
+        docs = [x.rstrip(b'\n').split(b'\t', 1)[1] for x in records]
+        self._sending = True
+        self.db.bulk_docs(docs, functools.partial(
+                self._sent, docs, segment, offset))
+
+    def _sent(self, docs, segment, offset, result):
+        self._sending = False
+        if result.error and result.errno not in _DATA_ERRORS:
+            log.warning('Saving queued documents to %s failed, retrying '
+                        'in %s seconds: %s', self.db.name, self._delay,
+                        result.msg)
+            self._metrics()
+            if self.running:
+                self._retry_timeout = self.db.server.io_loop.add_timeout(
+                    time.time() + self._delay, self._retry)
+                self._delay = min(self._delay * 2, self._max_retry_delay)
+            return
+        self._delay = self._retry_delay
+
+        if result.error:
+            self._report(docs, [result] * len(docs))
+        else:
+            self._report(docs, result)
+        self._commit(len(docs), segment, offset)
+        self._metrics()
+        self._drain()
+
+    def _report(self, docs, results):
+        for doc, item in zip(docs, results):
+            if item.error:
+                self.failed += 1
+                if self._on_error is not None:
+                    self._on_error(doc, item)
+            else:
+                self.drained += 1
+
+    def _retry(self):
+        self._retry_timeout = None
+        self._drain()
+
+    def _commit(self, count, segment, offset):
+        self.depth -= count
+        self._read_segment = segment
+        self._read_offset = offset
+        write_checkpoint(self._checkpoint,
+                         {'segment': segment, 'offset': offset})
+        for name in os.listdir(self.path):
+            if name.endswith('.log') and int(name[:-4]) < segment:
+                os.remove(os.path.join(self.path, name))
+        self._find_oldest()
+
+    def _find_oldest(self):
+        self._oldest = None
+        if self.depth:
+            records = self._read_batch(1)[0]
+            if records:
+                self._oldest = float(records[0].split(b'\t', 1)[0])
+
+    def _metrics(self):
+        self.db.server._metric('writebehind.depth', self.depth)
+        self.db.server._metric('writebehind.lag', self.lag)